@@ -1,8 +1,77 @@
+from .avanpost import (AvanpostSettings,
+                       get_settings,
+                       reload_settings,
+                       setup_settings_reload)
+from .batcher import (VerificationBatcher,
+                      VerifierSaturatedError,
+                      setup_verification_batcher)
+from .breaker import CircuitBreaker, setup_circuit_breaker
+from .cache import VerifiedTokenCache
+from .client import IdPClient, setup_idp_client
+from .instrumentation import (Instrumentation,
+                              LoggingInstrumentation,
+                              PrometheusInstrumentation,
+                              setup_instrumentation)
+from .issuers import IssuerRegistry, IssuerVerifier
+from .log import setup_logging
+from .loop_guard import (BlockingCallDetected,
+                         LoopLagGuard,
+                         setup_loop_lag_guard)
 from .middleware import AvanpostJWTMiddleware
+from .permissions import PermissionIndex
+from .pkce import PKCEStateStore, setup_pkce_sweeper
+from .revocation import (RevocationRegistry,
+                         revoke_token,
+                         setup_revocation)
+from .scheduler import RefreshScheduler, setup_refresh_scheduler
+from .shared_cache import (SharedMemoryTable,
+                           SharedTokenCache,
+                           setup_shared_cache)
+from .sessions import (SessionStore,
+                       RedisSessionStore,
+                       CookieSessionStore,
+                       setup_session_store)
 from .views import login, logout, sso_callback, refresh_tokens
 
 __all__ = (
+    'AvanpostSettings',
+    'get_settings',
+    'reload_settings',
+    'setup_settings_reload',
     'AvanpostJWTMiddleware',
+    'VerifiedTokenCache',
+    'VerificationBatcher',
+    'VerifierSaturatedError',
+    'setup_verification_batcher',
+    'CircuitBreaker',
+    'setup_circuit_breaker',
+    'IdPClient',
+    'setup_idp_client',
+    'Instrumentation',
+    'LoggingInstrumentation',
+    'PrometheusInstrumentation',
+    'setup_instrumentation',
+    'setup_logging',
+    'BlockingCallDetected',
+    'LoopLagGuard',
+    'setup_loop_lag_guard',
+    'IssuerRegistry',
+    'IssuerVerifier',
+    'PermissionIndex',
+    'PKCEStateStore',
+    'setup_pkce_sweeper',
+    'RevocationRegistry',
+    'revoke_token',
+    'setup_revocation',
+    'RefreshScheduler',
+    'setup_refresh_scheduler',
+    'SharedMemoryTable',
+    'SharedTokenCache',
+    'setup_shared_cache',
+    'SessionStore',
+    'RedisSessionStore',
+    'CookieSessionStore',
+    'setup_session_store',
     'login',
     'logout',
     'sso_callback',
@@ -1,35 +1,193 @@
-import get_config
-
-config = get_config()
-
-ISSUER = config.avanpost.issuer
-
-AUTHORIZATION_REDIRECT_URL = config.avanpost.authorization_redirect_url
-LOCALHOST_REDIRECT_URL = config.avanpost.localhost_redirect_url
-TOKEN_REDIRECT_URL = config.avanpost.token_redirect_url
-HOST = config.avanpost.host
-CLIENT_ID = config.avanpost.client_id
-CLIENT_SECRET = config.avanpost.client_secret
-USERINFO_URL = f"{ISSUER}/oauth2/userinfo"
-
-SCOPES = config.avanpost.scopes
-PARMA_ML_GROUP_NAME = config.avanpost.parma_ml_group_name
-DEFAULT_HASH_ALGORITHM = config.avanpost.default_hash_algorithm
-
-AUTHORIZATION_URL = (
-    f"{ISSUER}/"
-    "oauth2/authorize"
-    "?response_type=code"
-    "&client_id={client_id}"
-    "&scope={scopes}"
-    "&redirect_uri={redirect_url}"
-    "&code_challenge_method=S256"
-    "&code_challenge={code_challenge}"
-    "&state={state}"
-)
-TOKEN_URL = f"{ISSUER}/oauth2/token"
-PUBLIC_KEY_URL = f'{ISSUER}/oauth2/public_keys'
-TOKEN_REVOCATION_URL = f'{ISSUER}/oauth2/token/revoke'
+"""
+Avanpost settings.
+
+Configuration is read on first access rather than at import, and can
+be reloaded while the gateway is running. Settings are exposed both as
+an immutable ``AvanpostSettings`` object (``get_settings()``) and as
+module attributes (``avanpost.ISSUER``) that always reflect the current
+settings.
+"""
+import asyncio
+import signal
+import threading
+from dataclasses import dataclass, fields
+from typing import Optional, Tuple
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+import gateway_logger
+
+USERINFO_CLAIMS = ('aud', 'groups')
+REVOCATION_RETRIES = 2
+REVOCATION_TIMEOUT = 5
 
 CODE_VERIFIER_REDIS_KEY = "forest:sso:avanpost:code_verifier:{state}"
-TOKEN_REDIS_KEY = 'forest:sso:token:{access_token}'
+SESSION_REDIS_KEY = 'forest:sso:session:{session_id}'
+
+
+@dataclass(frozen=True)
+class AvanpostSettings:
+    issuer: str
+    authorization_redirect_url: str
+    localhost_redirect_url: str
+    token_redirect_url: str
+    host: str
+    client_id: str
+    client_secret: str
+    scopes: str
+    parma_ml_group_name: str
+    default_hash_algorithm: str
+
+    # Verify tokens without calling userinfo unless a claim is missing
+    local_verification: bool
+    audiences: Tuple[str, ...]
+    # Keep verifying against expired keys while the issuer is unreachable
+    jwks_stale_grace: float
+    code_verifier_ttl: int
+    pkce_states_per_client: int
+    session_ttl: int
+    session_compression: bool
+
+    # Issuer endpoints, built once per settings load
+    userinfo_url: str
+    authorization_url: str
+    # Authorization URL up to the per-login parameters
+    authorization_url_prefix: str
+    token_url: str
+    public_key_url: str
+    token_revocation_url: str
+
+    @classmethod
+    def from_config(cls, config) -> 'AvanpostSettings':
+        avanpost = config.avanpost
+        issuer = avanpost.issuer
+        constant_query = urlencode({
+            'response_type': 'code',
+            'client_id': avanpost.client_id,
+            'scope': avanpost.scopes,
+            'redirect_uri': avanpost.authorization_redirect_url,
+            'code_challenge_method': 'S256',
+        })
+        return cls(
+            issuer=issuer,
+            authorization_redirect_url=avanpost.authorization_redirect_url,
+            localhost_redirect_url=avanpost.localhost_redirect_url,
+            token_redirect_url=avanpost.token_redirect_url,
+            host=avanpost.host,
+            client_id=avanpost.client_id,
+            client_secret=avanpost.client_secret,
+            scopes=avanpost.scopes,
+            parma_ml_group_name=avanpost.parma_ml_group_name,
+            default_hash_algorithm=avanpost.default_hash_algorithm,
+            local_verification=getattr(avanpost, 'local_verification',
+                                       False),
+            audiences=tuple(getattr(avanpost, 'audiences', None)
+                            or (avanpost.client_id,)),
+            jwks_stale_grace=getattr(avanpost, 'jwks_stale_grace', 3600),
+            code_verifier_ttl=getattr(avanpost, 'code_verifier_ttl', 600),
+            pkce_states_per_client=getattr(avanpost,
+                                           'pkce_states_per_client', 32),
+            session_ttl=getattr(avanpost, 'session_ttl', 0),
+            session_compression=getattr(avanpost, 'session_compression',
+                                        False),
+            userinfo_url=f"{issuer}/oauth2/userinfo",
+            authorization_url=(
+                f"{issuer}/"
+                "oauth2/authorize"
+                "?response_type=code"
+                "&client_id={client_id}"
+                "&scope={scopes}"
+                "&redirect_uri={redirect_url}"
+                "&code_challenge_method=S256"
+                "&code_challenge={code_challenge}"
+                "&state={state}"
+            ),
+            authorization_url_prefix=(f"{issuer}/oauth2/authorize?"
+                                      f"{constant_query}"),
+            token_url=f"{issuer}/oauth2/token",
+            public_key_url=f'{issuer}/oauth2/public_keys',
+            token_revocation_url=f'{issuer}/oauth2/token/revoke',
+        )
+
+    def build_authorization_url(self, code_challenge: str,
+                                state: str) -> str:
+        # Both values are base64url and need no escaping
+        return (f"{self.authorization_url_prefix}"
+                f"&code_challenge={code_challenge}&state={state}")
+
+
+_FIELDS = frozenset(field.name for field in fields(AvanpostSettings))
+_settings: Optional[AvanpostSettings] = None
+_lock = threading.Lock()
+
+
+def _load(config=None) -> AvanpostSettings:
+    if config is None:
+        import get_config
+
+        config = get_config()
+    return AvanpostSettings.from_config(config)
+
+
+def get_settings() -> AvanpostSettings:
+    global _settings
+
+    settings = _settings
+    if settings is None:
+        with _lock:
+            if _settings is None:
+                _settings = _load()
+            settings = _settings
+    return settings
+
+
+def reload_settings(config=None) -> AvanpostSettings:
+    """
+    Read configuration again (or take ``config``) and swap it in.
+
+    Requests already holding the previous settings object finish with
+    it, new attribute reads see the new one.
+    """
+    global _settings
+
+    settings = _load(config)
+    with _lock:
+        _settings = settings
+    return settings
+
+
+def __getattr__(name: str):
+    field = name.lower()
+    if name.isupper() and field in _FIELDS:
+        return getattr(get_settings(), field)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def setup_settings_reload(app: web.Application,
+                          signum: int = signal.SIGHUP) -> None:
+    """
+    Reload settings on ``signum`` without restarting workers
+    """
+
+    def reload_in_background(loop):
+        # Reading configuration may block, keep it off the event loop
+        future = loop.run_in_executor(None, reload_settings)
+        future.add_done_callback(log_reload)
+
+    def log_reload(future):
+        if future.exception() is not None:
+            gateway_logger.error(f"Avanpost settings reload failed: "
+                                 f"{future.exception()!r}")
+        else:
+            gateway_logger.info("Avanpost settings reloaded")
+
+    async def add_reload_handler(app):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signum, reload_in_background, loop)
+
+    async def remove_reload_handler(app):
+        asyncio.get_running_loop().remove_signal_handler(signum)
+
+    app.on_startup.append(add_reload_handler)
+    app.on_cleanup.append(remove_reload_handler)
@@ -0,0 +1,201 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import jwt
+from aiohttp import web
+
+from .instrumentation import get_instrumentation
+
+_Item = Tuple[Union[str, bytes], object, dict]
+_CallKey = Tuple[Union[str, bytes], int, str]
+
+
+class VerifierSaturatedError(RuntimeError):
+    pass
+
+
+def _call_key(token: Union[str, bytes], key, kwargs: dict) -> _CallKey:
+    # Same token checked against another key, issuer or audience is a
+    # different call. The key is referenced by the batch, so its id is
+    # not reused while the call is pending.
+    return token, id(key), repr(sorted(kwargs.items()))
+
+
+def _decode_chunk(items: List[_Item]) -> List[object]:
+    results = []
+    for token, key, kwargs in items:
+        try:
+            results.append(jwt.decode(token, key, **kwargs))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class VerificationBatcher:
+    """
+    Verify bursts of token signatures on a thread pool.
+
+    Signature checks requested within ``window`` seconds are collected
+    into one batch, identical calls share one check, and the
+    batch is split across ``max_workers`` threads, so RSA math runs in
+    parallel and off the event loop. A batch is flushed early once it
+    holds ``max_batch`` tokens.
+
+    At most ``max_pending`` distinct tokens wait for or undergo a check,
+    further ones raise :class:`VerifierSaturatedError` instead of
+    queueing behind a burst of cold tokens.
+    """
+    WINDOW = 0.0005
+    MAX_BATCH = 64
+    MAX_PENDING = 1024
+
+    def __init__(self,
+                 window: float = WINDOW,
+                 max_batch: int = MAX_BATCH,
+                 max_workers: Optional[int] = None,
+                 executor: Optional[Executor] = None,
+                 max_pending: Optional[int] = MAX_PENDING,
+                 ):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            self.max_workers, thread_name_prefix='sso-verify')
+
+        self._batch: List[_Item] = []
+        self._futures: Dict[_CallKey, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+        self.batches = 0
+        self.verified = 0
+        self.deduplicated = 0
+        self.rejected = 0
+
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            'batches': self.batches,
+            'verified': self.verified,
+            'deduplicated': self.deduplicated,
+            'rejected': self.rejected,
+            'pending': len(self._futures),
+            'mean_batch': self.verified / self.batches if self.batches else 0,
+        }
+
+    async def decode(self, token: Union[str, bytes], key, **kwargs) -> dict:
+        """
+        ``jwt.decode(token, key, **kwargs)`` as part of the next batch
+        """
+        call_key = _call_key(token, key, kwargs)
+        future = self._futures.get(call_key)
+        if future is not None:
+            self.deduplicated += 1
+            return await asyncio.shield(future)
+        if self.max_pending and len(self._futures) >= self.max_pending:
+            self.rejected += 1
+            get_instrumentation().count('verification.rejected')
+            raise VerifierSaturatedError('Token verification queue is full')
+
+        loop = asyncio.get_running_loop()
+        future = self._futures[call_key] = loop.create_future()
+        self._batch.append((token, key, kwargs))
+        if len(self._batch) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[_Item]) -> None:
+        self.batches += 1
+        self.verified += len(batch)
+        get_instrumentation().count('verification.batched', len(batch))
+
+        loop = asyncio.get_running_loop()
+        size = -(-len(batch) // self.max_workers)
+        chunks = [batch[i:i + size] for i in range(0, len(batch), size)]
+        try:
+            results = await asyncio.gather(*(
+                loop.run_in_executor(self.executor, _decode_chunk, chunk)
+                for chunk in chunks))
+        except Exception as e:
+            results = [[e] * len(chunk) for chunk in chunks]
+
+        for chunk, chunk_results in zip(chunks, results):
+            for (token, key, kwargs), result in zip(chunk, chunk_results):
+                future = self._futures.pop(_call_key(token, key, kwargs))
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def run(self, func: Callable, *args):
+        """
+        ``func(*args)`` on the verification thread pool
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def close(self) -> None:
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+
+_batcher: Optional[VerificationBatcher] = None
+
+
+def get_verification_batcher() -> Optional[VerificationBatcher]:
+    return _batcher
+
+
+async def verify_signature(token: Union[str, bytes], key, **kwargs) -> dict:
+    """
+    ``jwt.decode``, batched on a thread pool if the batcher is set up
+    """
+    batcher = _batcher
+    if batcher is None:
+        return jwt.decode(token, key, **kwargs)
+    return await batcher.decode(token, key, **kwargs)
+
+
+async def offload(func: Callable, *args):
+    """
+    ``func(*args)`` on the verification thread pool if it is set up
+    """
+    batcher = _batcher
+    if batcher is None:
+        return func(*args)
+    return await batcher.run(func, *args)
+
+
+def setup_verification_batcher(app: web.Application,
+                               **kwargs) -> VerificationBatcher:
+    """
+    Verify cache-miss token signatures in batches on a thread pool
+    """
+    global _batcher
+
+    batcher = _batcher = VerificationBatcher(**kwargs)
+    app['verification_batcher'] = batcher
+
+    async def close_verification_batcher(app):
+        global _batcher
+
+        batcher.close()
+        _batcher = None
+
+    app.on_cleanup.append(close_verification_batcher)
+    return batcher
@@ -0,0 +1,81 @@
+"""
+SSO worker cold start benchmark.
+
+Measures, in fresh interpreters, how long ``import igt.sso`` takes and
+how long the first settings access takes after it:
+
+    python -m igt.sso.benchmarks.cold_start --runs 20
+
+With ``--compare <git ref>`` the same measurement is repeated on a
+temporary worktree of that revision, e.g. ``--compare HEAD~1``.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import igt.sso
+imported = time.perf_counter()
+from igt.sso import avanpost
+avanpost.ISSUER
+configured = time.perf_counter()
+print(json.dumps({'import': imported - started,
+                  'first_access': configured - imported}))
+"""
+
+
+def measure(root: Path, runs: int) -> Dict[str, List[float]]:
+    samples = {'import': [], 'first_access': []}
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=root,
+                                check=True, capture_output=True,
+                                text=True).stdout
+        for name, value in json.loads(output.splitlines()[-1]).items():
+            samples[name].append(value)
+    return samples
+
+
+def report(label: str, samples: Dict[str, List[float]]) -> None:
+    for name, values in samples.items():
+        print(f"{label:<12}{name:<14}"
+              f"{statistics.median(values) * 1000:>10.1f}"
+              f"{min(values) * 1000:>10.1f}"
+              f"{max(values) * 1000:>10.1f}")
+
+
+def main(args) -> None:
+    root = Path(__file__).resolve().parents[3]
+    print(f"{'revision':<12}{'stage':<14}{'p50 ms':>10}"
+          f"{'min ms':>10}{'max ms':>10}")
+    report('working', measure(root, args.runs))
+
+    if args.compare:
+        with tempfile.TemporaryDirectory() as worktree:
+            subprocess.run(['git', 'worktree', 'add', '--detach', worktree,
+                            args.compare], cwd=root, check=True,
+                           capture_output=True)
+            try:
+                report(args.compare, measure(Path(worktree), args.runs))
+            finally:
+                subprocess.run(['git', 'worktree', 'remove', '--force',
+                                worktree], cwd=root, check=True,
+                               capture_output=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--compare', metavar='REF',
+                        help='git revision to measure for comparison')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import secrets
+import time
+from collections import Counter
+from typing import Optional
+
+import jwt
+import jwt.algorithms
+from aiohttp import web
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from yarl import URL
+
+from .. import avanpost
+
+ALGORITHMS = ('RS256', 'ES256', 'EdDSA')
+
+
+def generate_signing_key(algorithm: str, key_size: int = 2048):
+    """
+    Return private key and its JWK algorithm class for ``algorithm``
+    """
+    if algorithm == 'RS256':
+        return (rsa.generate_private_key(public_exponent=65537,
+                                         key_size=key_size),
+                jwt.algorithms.RSAAlgorithm)
+    if algorithm == 'ES256':
+        return (ec.generate_private_key(ec.SECP256R1()),
+                jwt.algorithms.ECAlgorithm)
+    if algorithm == 'EdDSA':
+        return (ed25519.Ed25519PrivateKey.generate(),
+                jwt.algorithms.OKPAlgorithm)
+    raise ValueError(f'Unsupported algorithm: {algorithm}')
+
+
+class FakeAvanpost:
+    """
+    Local stand-in for the Avanpost issuer.
+
+    Serves authorize, token, userinfo, public_keys and revoke endpoints
+    under the configured issuer path with an artificial ``latency`` and
+    counts calls per endpoint.
+    """
+    KID = 'bench'
+
+    def __init__(self,
+                 issuer: str = None,
+                 latency: float = 0.0,
+                 expires_in: int = 300,
+                 jwks_max_age: int = 300,
+                 key_size: int = 2048,
+                 algorithm: str = 'RS256',
+                 ):
+        self.issuer = URL(issuer or avanpost.ISSUER)
+        self.latency = latency
+        self.expires_in = expires_in
+        self.jwks_max_age = jwks_max_age
+        self.algorithm = algorithm
+        self.private_key, self._jwk_algorithm = generate_signing_key(
+            algorithm, key_size)
+        self.calls = Counter()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def jwks(self) -> dict:
+        jwk = json.loads(self._jwk_algorithm.to_jwk(
+            self.private_key.public_key()))
+        jwk.update(kid=self.KID, alg=self.algorithm, use='sig')
+        return {'keys': [jwk]}
+
+    def issue_token(self, subject: str = None, **claims) -> str:
+        now = int(time.time())
+        payload = {
+            'iss': str(self.issuer),
+            'aud': avanpost.CLIENT_ID,
+            'sub': subject or secrets.token_hex(8),
+            'jti': secrets.token_hex(16),
+            'iat': now,
+            'exp': now + self.expires_in,
+            'groups': [{'name': avanpost.PARMA_ML_GROUP_NAME}],
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.private_key,
+                          algorithm=self.algorithm,
+                          headers={'kid': self.KID})
+
+    def token_response(self) -> dict:
+        return {
+            'access_token': self.issue_token(),
+            'refresh_token': secrets.token_urlsafe(32),
+            'token_type': 'Bearer',
+            'expires_in': self.expires_in,
+        }
+
+    async def _delay(self, endpoint: str) -> None:
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def authorize(self, request):
+        await self._delay('authorize')
+        location = URL(request.query['redirect_uri']).update_query(
+            code=secrets.token_urlsafe(16), state=request.query['state'])
+        raise web.HTTPFound(location)
+
+    async def token(self, request):
+        await self._delay('token')
+        return web.json_response(self.token_response())
+
+    async def userinfo(self, request):
+        await self._delay('userinfo')
+        token = request.headers['Authorization'].split(' ', 1)[1]
+        payload = jwt.decode(token, options={'verify_signature': False})
+        return web.json_response(payload)
+
+    async def public_keys(self, request):
+        await self._delay('public_keys')
+        return web.json_response(self.jwks(), headers={
+            'Cache-Control': f'public, max-age={self.jwks_max_age}'})
+
+    async def revoke(self, request):
+        await self._delay('revoke')
+        return web.json_response({})
+
+    def create_app(self) -> web.Application:
+        prefix = self.issuer.path.rstrip('/')
+        app = web.Application()
+        app.router.add_get(f'{prefix}/oauth2/authorize', self.authorize)
+        app.router.add_post(f'{prefix}/oauth2/token', self.token)
+        app.router.add_get(f'{prefix}/oauth2/userinfo', self.userinfo)
+        app.router.add_get(f'{prefix}/oauth2/public_keys', self.public_keys)
+        app.router.add_post(f'{prefix}/oauth2/token/revoke', self.revoke)
+        return app
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.issuer.host, self.issuer.port)
+        await site.start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
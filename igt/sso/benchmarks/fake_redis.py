@@ -0,0 +1,327 @@
+import asyncio
+import fnmatch
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from ..singleflight import RELEASE_LOCK_SCRIPT
+
+
+def _encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return str(value).encode('utf-8')
+
+
+def _decode(value: Optional[bytes], encoding: Optional[str]):
+    if value is None or encoding is None:
+        return value
+    return value.decode(encoding)
+
+
+_CLOSED = object()
+
+
+class FakeChannel:
+    def __init__(self, name: str):
+        self.name = name
+        self._queue = asyncio.Queue()
+        self._pending = None
+
+    @property
+    def is_active(self) -> bool:
+        return self._pending is not _CLOSED
+
+    async def wait_message(self) -> bool:
+        if self._pending is None:
+            self._pending = await self._queue.get()
+        return self.is_active
+
+    async def get(self, encoding: Optional[str] = None):
+        if self._pending is None:
+            self._pending = await self._queue.get()
+        if self._pending is _CLOSED:
+            return None
+        message, self._pending = self._pending, None
+        return _decode(message, encoding)
+
+    def put(self, message: bytes) -> None:
+        self._queue.put_nowait(message)
+
+    def close(self) -> None:
+        self._queue.put_nowait(_CLOSED)
+
+
+class FakeTransaction:
+    """
+    Queued MULTI/EXEC: commands return futures, ``execute`` runs them
+    """
+
+    def __init__(self, redis: 'FakeRedis'):
+        self._redis = redis
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._redis, name)
+
+        def queue(*args, **kwargs):
+            future = asyncio.get_running_loop().create_future()
+            self._commands.append((command, args, kwargs, future))
+            return future
+        return queue
+
+    async def execute(self):
+        results = []
+        for command, args, kwargs, future in self._commands:
+            result = await command(*args, **kwargs)
+            future.set_result(result)
+            results.append(result)
+        return results
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the subset of the aioredis 1.x API used by SSO
+    """
+    SET_IF_NOT_EXIST = 'SET_IF_NOT_EXIST'
+    SET_IF_EXIST = 'SET_IF_EXIST'
+
+    def __init__(self):
+        self._data: Dict[str, object] = {}
+        self._expires: Dict[str, float] = {}
+        self._channels: Dict[str, FakeChannel] = {}
+
+    def _alive(self, key: str) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _set_expiry(self, key: str, seconds: Optional[float]) -> None:
+        if seconds:
+            self._expires[key] = time.monotonic() + seconds
+        else:
+            self._expires.pop(key, None)
+
+    def multi_exec(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    pipeline = multi_exec
+
+    async def get(self, key, *, encoding=None):
+        if not self._alive(key):
+            return None
+        return _decode(self._data[key], encoding)
+
+    async def set(self, key, value, *, expire=0, pexpire=0, exist=None):
+        alive = self._alive(key)
+        if exist == self.SET_IF_NOT_EXIST and alive:
+            return False
+        if exist == self.SET_IF_EXIST and not alive:
+            return False
+        self._data[key] = _encode(value)
+        self._set_expiry(key, expire or pexpire / 1000)
+        return True
+
+    async def eval(self, script, keys=(), args=()):
+        # Only the lock release of RefreshCoalescer is supported
+        if script != RELEASE_LOCK_SCRIPT:
+            raise NotImplementedError('Unknown script')
+        key, = keys
+        if await self.get(key) != _encode(args[0]):
+            return 0
+        return await self.delete(key)
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._alive(key):
+                del self._data[key]
+                self._expires.pop(key, None)
+                deleted += 1
+        return deleted
+
+    async def exists(self, *keys):
+        return sum(self._alive(key) for key in keys)
+
+    async def expire(self, key, timeout):
+        if not self._alive(key):
+            return False
+        self._set_expiry(key, timeout)
+        return True
+
+    async def ttl(self, key):
+        if not self._alive(key):
+            return -2
+        expires_at = self._expires.get(key)
+        if expires_at is None:
+            return -1
+        return int(expires_at - time.monotonic())
+
+    async def incr(self, key):
+        value = int(self._data.get(key, b'0')) + 1 if self._alive(key) else 1
+        self._data[key] = _encode(value)
+        return value
+
+    async def hset(self, key, field, value):
+        if not self._alive(key):
+            self._data[key] = {}
+        field = _encode(field)
+        created = field not in self._data[key]
+        self._data[key][field] = _encode(value)
+        return int(created)
+
+    async def hmset_dict(self, key, *args, **kwargs):
+        if not self._alive(key):
+            self._data[key] = {}
+        mapping = dict(*args, **kwargs)
+        self._data[key].update((_encode(field), _encode(value))
+                               for field, value in mapping.items())
+        return True
+
+    async def hget(self, key, field, *, encoding=None):
+        if not self._alive(key):
+            return None
+        return _decode(self._data[key].get(_encode(field)), encoding)
+
+    async def hgetall(self, key, *, encoding=None):
+        if not self._alive(key):
+            return {}
+        return {_decode(field, encoding): _decode(value, encoding)
+                for field, value in self._data[key].items()}
+
+    async def zadd(self, key, score, member, *pairs):
+        if not self._alive(key):
+            self._data[key] = {}
+        items = [(score, member), *zip(pairs[::2], pairs[1::2])]
+        added = 0
+        for score, member in items:
+            member = _encode(member)
+            added += member not in self._data[key]
+            self._data[key][member] = float(score)
+        return added
+
+    async def zrem(self, key, *members):
+        if not self._alive(key):
+            return 0
+        return sum(self._data[key].pop(_encode(member), None) is not None
+                   for member in members)
+
+    async def zremrangebyscore(self, key, min=float('-inf'),
+                               max=float('inf')):
+        if not self._alive(key):
+            return 0
+        members = [member for member, score in self._data[key].items()
+                   if min <= score <= max]
+        for member in members:
+            del self._data[key][member]
+        return len(members)
+
+    async def zpopmin(self, key, count=None, *, encoding=None):
+        if not self._alive(key):
+            return []
+        popped = sorted((score, member)
+                        for member, score in self._data[key].items())
+        result = []
+        for score, member in popped[:count or 1]:
+            del self._data[key][member]
+            result.extend((_decode(member, encoding), score))
+        return result
+
+    async def zcard(self, key):
+        return len(self._data[key]) if self._alive(key) else 0
+
+    async def zrangebyscore(self, key, min=float('-inf'), max=float('inf'),
+                            *, offset=None, count=None, encoding=None):
+        if not self._alive(key):
+            return []
+        members = sorted((score, member)
+                         for member, score in self._data[key].items()
+                         if min <= score <= max)
+        members = [_decode(member, encoding) for _, member in members]
+        if offset is not None:
+            members = members[offset:offset + count]
+        return members
+
+    async def publish(self, channel, message):
+        subscriber = self._channels.get(channel)
+        if subscriber is None:
+            return 0
+        subscriber.put(_encode(message))
+        return 1
+
+    async def subscribe(self, *channels):
+        result = []
+        for name in channels:
+            channel = self._channels[name] = FakeChannel(name)
+            result.append(channel)
+        return result
+
+    async def unsubscribe(self, *channels):
+        for name in channels:
+            channel = self._channels.pop(name, None)
+            if channel is not None:
+                channel.close()
+
+    async def iscan(self, *, match=None, count=None):
+        for key in list(self._data):
+            if self._alive(key) and (match is None
+                                     or fnmatch.fnmatchcase(key, match)):
+                yield key.encode('utf-8')
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class CountingRedis:
+    """
+    Proxy counting Redis round trips per command.
+
+    A MULTI/EXEC or pipeline counts as one round trip on ``execute``.
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+        self.calls = Counter()
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def multi_exec(self):
+        return _CountingTransaction(self._redis.multi_exec(), self.calls)
+
+    def pipeline(self):
+        return _CountingTransaction(self._redis.pipeline(), self.calls)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._redis, name)
+        if not callable(attribute) or name.startswith('_') or name in (
+                'iscan', 'close', 'wait_closed'):
+            return attribute
+
+        calls = self.calls
+
+        def call(*args, **kwargs):
+            calls[name] += 1
+            return attribute(*args, **kwargs)
+        return call
+
+
+class _CountingTransaction:
+    def __init__(self, transaction, calls: Counter):
+        self._transaction = transaction
+        self._calls = calls
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    async def execute(self):
+        self._calls['multi_exec'] += 1
+        return await self._transaction.execute()
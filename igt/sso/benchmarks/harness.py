@@ -0,0 +1,278 @@
+"""
+SSO gateway benchmark.
+
+Starts a local Avanpost stand-in on the configured issuer address (point
+``avanpost.issuer`` at e.g. ``http://127.0.0.1:9400`` in the benchmark
+config), an in-memory Redis stand-in or a real Redis with ``--redis`` and
+drives the gateway app under concurrent load:
+
+    python -m igt.sso.benchmarks.harness --requests 2000 --concurrency 50
+
+Reports throughput, latency percentiles and IdP/Redis calls per request
+for the JWT middleware, login, sso_callback, refresh_tokens and logout.
+With ``--loop-guard SECONDS`` the run fails with ``BlockingCallDetected``
+if any of them blocked the event loop for longer than that.
+"""
+import argparse
+import asyncio
+import time
+from typing import Awaitable, Callable, List
+
+import aiohttp
+import aioredis
+from aiohttp import hdrs, web
+from yarl import URL
+
+from .. import views
+from ..batcher import setup_verification_batcher
+from ..cache import VerifiedTokenCache
+from ..client import setup_idp_client
+from ..loop_guard import setup_loop_lag_guard
+from ..middleware import AvanpostJWTMiddleware
+from ..utils import is_revoked, set_tokens
+from .fake_idp import ALGORITHMS, FakeAvanpost
+from .fake_redis import CountingRedis, FakeRedis
+
+SCENARIOS = ('middleware', 'login', 'sso_callback', 'refresh_tokens',
+             'logout')
+
+
+def bearer_token(request: web.Request):
+    scheme, _, token = request.headers.get(hdrs.AUTHORIZATION, '').partition(
+        ' ')
+    return token if scheme == 'Bearer' and token else None
+
+
+async def ping(request):
+    return web.json_response({'status': 'ok'})
+
+
+async def refresh(request):
+    # Gateway puts the client's token pair into the payload upstream
+    request['payload'] = await request.json()
+    return await views.refresh_tokens(request)
+
+
+def create_gateway(redis, token_cache=True,
+                   batch_verification=False,
+                   loop_guard=None) -> web.Application:
+    middleware = AvanpostJWTMiddleware(
+        signing_key='avanpost',
+        whitelist=(r'/login$', r'/callback$', r'/refresh$'),
+        token_getter=bearer_token,
+        is_revoked=is_revoked,
+        store_token='sso_token',
+        token_cache=VerifiedTokenCache() if token_cache else None,
+    )
+    app = web.Application(middlewares=[middleware])
+    app['redis'] = redis
+    setup_idp_client(app)
+    if batch_verification:
+        setup_verification_batcher(app)
+    if loop_guard is not None:
+        setup_loop_lag_guard(app, threshold=loop_guard, strict=True)
+    app.router.add_get('/login', views.login)
+    app.router.add_get('/callback', views.sso_callback)
+    app.router.add_post('/refresh', refresh)
+    app.router.add_post('/logout', views.logout)
+    app.router.add_get('/api/ping', ping)
+    return app
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+
+class ScenarioResult:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self.idp_calls = 0
+        self.redis_calls = 0
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+    def row(self) -> str:
+        requests = self.requests or 1
+        return (f"{self.name:<16}"
+                f"{self.requests / self.elapsed if self.elapsed else 0:>10.1f}"
+                f"{percentile(self.latencies, 0.50) * 1000:>9.2f}"
+                f"{percentile(self.latencies, 0.95) * 1000:>9.2f}"
+                f"{percentile(self.latencies, 0.99) * 1000:>9.2f}"
+                f"{self.idp_calls / requests:>8.2f}"
+                f"{self.redis_calls / requests:>8.2f}"
+                f"{self.errors:>8}")
+
+    HEADER = (f"{'scenario':<16}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}"
+              f"{'p99 ms':>9}{'idp/rq':>8}{'rds/rq':>8}{'errors':>8}")
+
+
+class Benchmark:
+    def __init__(self, idp: FakeAvanpost, redis: CountingRedis,
+                 session: aiohttp.ClientSession, base_url: URL,
+                 requests: int, concurrency: int, distinct_tokens: int):
+        self.idp = idp
+        self.redis = redis
+        self.session = session
+        self.base_url = base_url
+        self.requests = requests
+        self.concurrency = concurrency
+        self.tokens = [idp.issue_token() for _ in range(distinct_tokens)]
+
+    async def run(self, name: str,
+                  prepare: Callable[[int], Awaitable],
+                  send: Callable[[object], Awaitable[bool]],
+                  ) -> ScenarioResult:
+        result = ScenarioResult(name)
+        contexts = [await prepare(i) for i in range(self.requests)]
+        idp_calls, redis_calls = self.idp.total_calls, self.redis.total_calls
+
+        async def worker():
+            while contexts:
+                context = contexts.pop()
+                started = time.perf_counter()
+                try:
+                    ok = await send(context)
+                except aiohttp.ClientError:
+                    ok = False
+                result.latencies.append(time.perf_counter() - started)
+                result.errors += not ok
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        result.elapsed = time.perf_counter() - started
+        result.idp_calls = self.idp.total_calls - idp_calls
+        result.redis_calls = self.redis.total_calls - redis_calls
+        return result
+
+    async def _status(self, method, path, expected, **kwargs) -> bool:
+        async with self.session.request(method, self.base_url.with_path(path),
+                                        allow_redirects=False,
+                                        **kwargs) as response:
+            await response.read()
+            return response.status == expected
+
+    async def _login_state(self) -> str:
+        async with self.session.get(self.base_url.with_path('/login'),
+                                    allow_redirects=False) as response:
+            return URL(response.headers[hdrs.LOCATION]).query['state']
+
+    async def _session(self, expired=False) -> dict:
+        tokens = self.idp.token_response()
+        await set_tokens(self.redis, tokens['access_token'],
+                         tokens['refresh_token'],
+                         -1 if expired else tokens['expires_in'])
+        return tokens
+
+    def _auth(self, token: str) -> dict:
+        return {'headers': {hdrs.AUTHORIZATION: f'Bearer {token}'}}
+
+    async def middleware(self) -> ScenarioResult:
+        async def prepare(i):
+            return self.tokens[i % len(self.tokens)]
+
+        return await self.run(
+            'middleware', prepare,
+            lambda token: self._status('GET', '/api/ping', 200,
+                                       **self._auth(token)))
+
+    async def login(self) -> ScenarioResult:
+        async def prepare(i):
+            return None
+
+        return await self.run(
+            'login', prepare,
+            lambda _: self._status('GET', '/login', 302))
+
+    async def sso_callback(self) -> ScenarioResult:
+        async def prepare(i):
+            return await self._login_state()
+
+        return await self.run(
+            'sso_callback', prepare,
+            lambda state: self._status('GET', '/callback', 302, params={
+                'code': 'bench', 'state': state}))
+
+    async def refresh_tokens(self) -> ScenarioResult:
+        async def prepare(i):
+            return await self._session(expired=True)
+
+        return await self.run(
+            'refresh_tokens', prepare,
+            lambda tokens: self._status('POST', '/refresh', 200, json={
+                'access_token': tokens['access_token'],
+                'refresh_token': tokens['refresh_token']}))
+
+    async def logout(self) -> ScenarioResult:
+        async def prepare(i):
+            return await self._session()
+
+        return await self.run(
+            'logout', prepare,
+            lambda tokens: self._status('POST', '/logout', 204,
+                                        **self._auth(tokens['access_token'])))
+
+
+async def main(args) -> None:
+    idp = FakeAvanpost(latency=args.idp_latency, algorithm=args.algorithm)
+    await idp.start()
+
+    backend = (await aioredis.create_redis_pool(args.redis) if args.redis
+               else FakeRedis())
+    redis = CountingRedis(backend)
+
+    runner = web.AppRunner(create_gateway(
+        redis, token_cache=not args.no_cache,
+        batch_verification=args.batch_verification,
+        loop_guard=args.loop_guard))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+
+    base_url = URL.build(scheme='http', host='127.0.0.1', port=args.port)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        benchmark = Benchmark(idp, redis, session, base_url,
+                              args.requests, args.concurrency,
+                              args.distinct_tokens)
+        print(ScenarioResult.HEADER)
+        for name in args.scenarios:
+            result = await getattr(benchmark, name)()
+            print(result.row())
+
+    await runner.cleanup()
+    await idp.stop()
+    backend.close()
+    await backend.wait_closed()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--idp-latency', type=float, default=0.02,
+                        help='artificial IdP latency, seconds')
+    parser.add_argument('--algorithm', default='RS256', choices=ALGORITHMS,
+                        help='token signing algorithm of the IdP')
+    parser.add_argument('--distinct-tokens', type=int, default=100)
+    parser.add_argument('--redis', help='Redis URL, in-memory if omitted')
+    parser.add_argument('--port', type=int, default=9401)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable verified-token cache')
+    parser.add_argument('--batch-verification', action='store_true',
+                        help='verify signatures in batches on a thread pool')
+    parser.add_argument('--loop-guard', type=float, metavar='SECONDS',
+                        help='fail if the event loop is blocked longer')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS,
+                        choices=SCENARIOS)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,85 @@
+"""
+SSO debug logging overhead benchmark.
+
+Times the call site of a typical IdP debug record, the former eager
+f-string against ``log.debug``, with debug off and with debug on. With
+debug on the f-string is written by a synchronous handler and
+``log.debug`` goes through the queue set up by ``setup_logging``:
+
+    python -m igt.sso.benchmarks.log_bench --iterations 100000
+"""
+import argparse
+import logging
+import os
+import time
+
+from aiohttp import web
+from multidict import CIMultiDict
+from yarl import URL
+
+from .. import log
+
+URL_ = URL('https://sso.example.com/oauth2/token')
+HEADERS = CIMultiDict({
+    'Host': 'sso.example.com',
+    'Content-Type': 'application/json',
+    'Authorization': 'Bearer ' + 'x' * 900,
+    'User-Agent': 'Python/3.11 aiohttp/3.8',
+})
+RESPONSE = {
+    'access_token': 'a' * 900,
+    'refresh_token': 'r' * 900,
+    'token_type': 'Bearer',
+    'expires_in': 300,
+}
+
+
+def eager(logger: logging.Logger) -> None:
+    logger.debug(f"Requested Access Token refresh. "
+                 f"Request URL: {URL_} \n"
+                 f"Request Headers: {HEADERS} \n"
+                 f"Got response: {RESPONSE}")
+
+
+def structured() -> None:
+    log.debug('idp refresh', url=URL_, headers=HEADERS, body=RESPONSE)
+
+
+def rate(name: str, func, iterations: int) -> None:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<24}{elapsed / iterations * 1e9:>12.0f}")
+
+
+def main(args) -> None:
+    devnull = open(os.devnull, 'w')
+    eager_logger = logging.getLogger('igt.sso.benchmarks.eager')
+    eager_logger.propagate = False
+    eager_logger.addHandler(logging.StreamHandler(devnull))
+
+    print(f"{'call site':<24}{'ns/call':>12}")
+    eager_logger.setLevel(logging.INFO)
+    log.logger.setLevel(logging.INFO)
+    rate('f-string, debug off', lambda: eager(eager_logger), args.iterations)
+    rate('log.debug, debug off', structured, args.iterations)
+
+    eager_logger.setLevel(logging.DEBUG)
+    app = web.Application()
+    listener = log.setup_logging(app, [logging.StreamHandler(devnull)])
+    rate('f-string, debug on', lambda: eager(eager_logger), args.iterations)
+    rate('log.debug, debug on', structured, args.iterations)
+
+    listener.stop()
+    devnull.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=100000)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_args())
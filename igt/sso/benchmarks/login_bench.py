@@ -0,0 +1,103 @@
+"""
+Login endpoint microbenchmark.
+
+Compares the per-login CPU work of the former path (three async
+helpers, regex stripping, ``str.format`` of the full authorization URL)
+with ``generate_pkce`` plus the prebound URL builder, then drives the
+``login`` handler itself against the in-memory Redis stand-in:
+
+    python -m igt.sso.benchmarks.login_bench --iterations 100000
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from .. import avanpost, views
+from ..pkce import generate_pkce
+from ..utils import generate_state, get_code_challenge, get_code_verifier
+from .fake_redis import CountingRedis, FakeRedis
+
+SAMPLE_CONFIG = SimpleNamespace(avanpost=SimpleNamespace(
+    issuer='https://sso.example.com',
+    authorization_redirect_url='https://gateway.example.com/sso/callback',
+    localhost_redirect_url='http://localhost:8080/sso/callback',
+    token_redirect_url='https://app.example.com/#{access_token}'
+                       '&{refresh_token}',
+    host='sso.example.com',
+    client_id='gateway',
+    client_secret='secret',
+    scopes='openid profile groups',
+    parma_ml_group_name='parma-ml',
+    default_hash_algorithm='RS256',
+))
+
+
+async def legacy_login_url(settings: avanpost.AvanpostSettings) -> str:
+    state = await generate_state()
+    code_verifier = await get_code_verifier()
+    return settings.authorization_url.format(
+        scopes=settings.scopes,
+        redirect_url=settings.authorization_redirect_url,
+        code_challenge=await get_code_challenge(code_verifier),
+        client_id=settings.client_id,
+        state=state,
+    )
+
+
+async def prebound_login_url(settings: avanpost.AvanpostSettings) -> str:
+    pkce = generate_pkce()
+    return settings.build_authorization_url(pkce.code_challenge, pkce.state)
+
+
+async def login_handler(app: web.Application) -> None:
+    # Without the pre-login cookie every login is a new browser
+    request = make_mocked_request('GET', '/login', app=app)
+    try:
+        await views.login(request)
+    except web.HTTPFound:
+        pass
+
+
+async def rate(name: str, func, iterations: int) -> None:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<18}{iterations / elapsed:>12.0f}"
+          f"{elapsed / iterations * 1e6:>12.2f}")
+
+
+async def main(args) -> None:
+    try:
+        settings = avanpost.get_settings()
+    except ImportError:
+        settings = avanpost.reload_settings(SAMPLE_CONFIG)
+
+    redis = CountingRedis(FakeRedis())
+    app = web.Application()
+    app['redis'] = redis
+
+    print(f"{'path':<18}{'ops/s':>12}{'us/op':>12}")
+    await rate('legacy url', lambda: legacy_login_url(settings),
+               args.iterations)
+    await rate('prebound url', lambda: prebound_login_url(settings),
+               args.iterations)
+    calls = redis.total_calls
+    await rate('login handler', lambda: login_handler(app),
+               args.iterations)
+    print(f"redis calls per login: "
+          f"{(redis.total_calls - calls) / args.iterations:.2f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=20000)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
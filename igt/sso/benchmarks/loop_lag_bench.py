@@ -0,0 +1,97 @@
+"""
+Event loop lag under a burst of cold tokens.
+
+Verifies a burst of distinct, never cached tokens at once, inline on
+the event loop and through ``VerificationBatcher`` on a thread pool,
+while ``LoopLagGuard`` measures how late the loop wakes up. Inline
+verification stalls the loop for the whole burst, so every unrelated
+request on the worker waits. With the executor the lag stays flat and
+tokens beyond ``--max-pending`` are rejected, as the middleware would
+with 503:
+
+    python -m igt.sso.benchmarks.loop_lag_bench --burst 500
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+
+import jwt
+
+from ..batcher import VerificationBatcher, VerifierSaturatedError
+from ..jwks import JWKSStore
+from ..loop_guard import LoopLagGuard
+from .fake_idp import ALGORITHMS, FakeAvanpost
+from .harness import percentile
+
+ISSUER = 'https://sso.example.com'
+OPTIONS = {'verify_aud': False, 'require': ['exp', 'iss']}
+
+
+async def burst(name: str, verify, tokens: List[str], interval: float):
+    latencies = []
+    rejected = 0
+
+    async def one(token):
+        nonlocal rejected
+        started = time.perf_counter()
+        try:
+            await verify(token)
+        except VerifierSaturatedError:
+            rejected += 1
+            return
+        latencies.append(time.perf_counter() - started)
+
+    guard = LoopLagGuard(interval=interval, threshold=interval)
+    async with guard:
+        # Let the guard take a baseline wake-up first
+        await asyncio.sleep(interval * 2)
+        started = time.perf_counter()
+        await asyncio.gather(*(one(token) for token in tokens))
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(interval * 2)
+
+    print(f"{name:<10}{len(tokens):>8}{elapsed * 1000:>12.1f}"
+          f"{guard.max_lag * 1000:>12.1f}"
+          f"{percentile(latencies, 0.99) * 1000:>10.1f}"
+          f"{rejected:>10}")
+
+
+async def main(args) -> None:
+    idp = FakeAvanpost(ISSUER, algorithm=args.algorithm)
+    signing_key = JWKSStore._parse(idp.jwks())[FakeAvanpost.KID]
+    kwargs = dict(algorithms=[signing_key.algorithm], issuer=ISSUER,
+                  options=OPTIONS)
+
+    async def inline(token):
+        return jwt.decode(token, signing_key.key, **kwargs)
+
+    batcher = VerificationBatcher(max_workers=args.workers,
+                                  max_pending=args.max_pending)
+
+    async def executor(token):
+        return await batcher.decode(token, signing_key.key, **kwargs)
+
+    print(f"{'mode':<10}{'tokens':>8}{'total ms':>12}{'max lag ms':>12}"
+          f"{'p99 ms':>10}{'rejected':>10}")
+    for name, verify in (('inline', inline), ('executor', executor)):
+        tokens = [idp.issue_token() for _ in range(args.burst)]
+        await burst(name, verify, tokens, args.interval)
+    batcher.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--burst', type=int, default=500,
+                        help='distinct tokens verified at once')
+    parser.add_argument('--algorithm', default='RS256', choices=ALGORITHMS)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-pending', type=int,
+                        default=VerificationBatcher.MAX_PENDING)
+    parser.add_argument('--interval', type=float, default=0.005,
+                        help='lag probe interval, seconds')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
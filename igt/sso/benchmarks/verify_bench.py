@@ -0,0 +1,64 @@
+"""
+Token signature verification microbenchmark.
+
+For every supported IdP algorithm, issues a token with a fresh key and
+reports verifications per second with the key object prebuilt by
+``JWKSStore`` and with the key rebuilt from its JWK on every call:
+
+    python -m igt.sso.benchmarks.verify_bench --iterations 5000
+"""
+import argparse
+import time
+
+import jwt
+
+from ..jwks import JWKSStore
+from .fake_idp import ALGORITHMS, FakeAvanpost
+
+ISSUER = 'https://sso.example.com'
+
+
+def rate(func, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - started)
+
+
+def bench(algorithm: str, iterations: int) -> None:
+    idp = FakeAvanpost(ISSUER, algorithm=algorithm)
+    token = idp.issue_token()
+    jwk = idp.jwks()['keys'][0]
+    signing_key = JWKSStore._parse({'keys': [jwk]})[FakeAvanpost.KID]
+    options = {'verify_aud': False, 'require': ['exp', 'iss']}
+
+    def prebuilt():
+        jwt.decode(token, signing_key.key, algorithms=[signing_key.algorithm],
+                   issuer=ISSUER, options=options)
+
+    def per_call():
+        key = JWKSStore._parse({'keys': [jwk]})[FakeAvanpost.KID].key
+        jwt.decode(token, key, algorithms=[algorithm],
+                   issuer=ISSUER, options=options)
+
+    print(f"{algorithm:<10}{len(token):>8}"
+          f"{rate(prebuilt, iterations):>14.0f}"
+          f"{rate(per_call, iterations):>14.0f}")
+
+
+def main(args) -> None:
+    print(f"{'alg':<10}{'bytes':>8}{'prebuilt/s':>14}{'per call/s':>14}")
+    for algorithm in args.algorithms:
+        bench(algorithm, args.iterations)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--algorithms', nargs='+', default=ALGORITHMS,
+                        choices=ALGORITHMS)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,148 @@
+import asyncio
+import http
+import time
+from functools import wraps
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import aiohttp
+from aiohttp import web
+
+import gateway_logger
+from .instrumentation import get_instrumentation
+
+T = TypeVar('T')
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of calling the IdP while the circuit is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Fail fast on identity provider calls during an outage.
+
+    Every call is bounded by ``timeout``. After ``failure_threshold``
+    consecutive timeouts, connection errors or 5xx responses the circuit
+    opens and calls raise ``CircuitOpenError`` without touching the
+    network. After ``recovery_timeout`` seconds a single trial call is
+    let through: success closes the circuit, failure reopens it.
+    """
+    FAILURE_THRESHOLD = 5
+    RECOVERY_TIMEOUT = 30
+    TIMEOUT = 5
+
+    def __init__(self,
+                 failure_threshold: int = FAILURE_THRESHOLD,
+                 recovery_timeout: float = RECOVERY_TIMEOUT,
+                 timeout: float = TIMEOUT,
+                 ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.timeout = timeout
+
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def stats(self) -> Dict[str, object]:
+        return {
+            'state': self.state,
+            'failures': self._failures,
+            'rejected': self.rejected,
+            'trips': self.trips,
+        }
+
+    @property
+    def is_open(self) -> bool:
+        return (self.state == OPEN
+                and time.monotonic() - self._opened_at
+                < self.recovery_timeout)
+
+    def _acquire(self) -> None:
+        if self.state == CLOSED:
+            return
+        if self.is_open or self._trial_in_flight:
+            self.rejected += 1
+            get_instrumentation().count('idp.circuit_rejected')
+            raise CircuitOpenError('Identity provider circuit is open')
+        self.state = HALF_OPEN
+        self._trial_in_flight = True
+
+    def _record_success(self) -> None:
+        if self.state != CLOSED:
+            gateway_logger.info("Identity provider circuit closed")
+        self.state = CLOSED
+        self._failures = 0
+        self._trial_in_flight = False
+
+    def _record_failure(self) -> None:
+        self._failures += 1
+        self._trial_in_flight = False
+        if (self.state == HALF_OPEN
+                or self._failures >= self.failure_threshold):
+            if self.state != OPEN:
+                self.trips += 1
+                gateway_logger.warning(
+                    f"Identity provider circuit opened after "
+                    f"{self._failures} failures")
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+
+    @staticmethod
+    def is_failure(exc: BaseException) -> bool:
+        if isinstance(exc, (aiohttp.ClientResponseError,
+                            web.HTTPException)):
+            return exc.status >= http.HTTPStatus.INTERNAL_SERVER_ERROR
+        return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def call(self, func: Callable[[], Awaitable[T]],
+                   timeout: Optional[float] = None) -> T:
+        self._acquire()
+        try:
+            result = await asyncio.wait_for(func(), timeout or self.timeout)
+        except asyncio.CancelledError:
+            self._trial_in_flight = False
+            raise
+        except Exception as e:
+            if self.is_failure(e):
+                self._record_failure()
+            else:
+                self._record_success()
+            raise
+        self._record_success()
+        return result
+
+
+_breaker = CircuitBreaker()
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    return _breaker
+
+
+def setup_circuit_breaker(app: web.Application, **kwargs) -> CircuitBreaker:
+    global _breaker
+
+    breaker = _breaker = CircuitBreaker(**kwargs)
+    app['idp_circuit_breaker'] = breaker
+    return breaker
+
+
+def guarded(func):
+    """
+    Run a coroutine function through the IdP circuit breaker
+    """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await _breaker.call(lambda: func(*args, **kwargs))
+    return wrapper
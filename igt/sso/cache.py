@@ -0,0 +1,124 @@
+import hashlib
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Union
+
+
+class CachedToken(NamedTuple):
+    payload: dict
+    groups_mask: int
+    expires_at: float
+    size: int
+
+
+def token_digest(token: Union[str, bytes]) -> bytes:
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).digest()
+
+
+def _sizeof(obj) -> int:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(key) + _sizeof(value)
+                    for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(item) for item in obj)
+    return size
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of verified tokens keyed by SHA-256 digest of the token.
+
+    An entry lives until the token's ``exp`` claim (capped by
+    ``max_ttl``) and holds the decoded payload with its compiled group
+    mask, so repeated requests skip signature verification and the
+    group scan.
+    """
+    DEFAULT_MAXSIZE = 10_000
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE,
+                 max_ttl: Optional[float] = None):
+        if maxsize <= 0:
+            raise ValueError('maxsize should be positive')
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self._entries: 'OrderedDict[bytes, CachedToken]' = OrderedDict()
+        self._memory = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token: Union[str, bytes]) -> Optional[CachedToken]:
+        digest = token_digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.time():
+            self._remove(digest)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return entry
+
+    def set(self, token: Union[str, bytes], payload: dict,
+            groups_mask: int) -> None:
+        expires_at = payload.get('exp')
+        if expires_at is None:
+            # Never cache tokens without expiry
+            return
+        if self.max_ttl is not None:
+            expires_at = min(expires_at, time.time() + self.max_ttl)
+
+        digest = token_digest(token)
+        self._remove(digest)
+        entry = CachedToken(payload, groups_mask, expires_at,
+                            len(digest) + _sizeof(payload))
+        self._entries[digest] = entry
+        self._memory += entry.size
+
+        while len(self._entries) > self.maxsize:
+            _, evicted = self._entries.popitem(last=False)
+            self._memory -= evicted.size
+            self.evictions += 1
+
+    def invalidate(self, token: Union[str, bytes]) -> None:
+        if self._remove(token_digest(token)):
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._memory = 0
+
+    def _remove(self, digest: bytes) -> bool:
+        entry = self._entries.pop(digest, None)
+        if entry is None:
+            return False
+        self._memory -= entry.size
+        return True
+
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'memory_bytes': self._memory,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
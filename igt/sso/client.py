@@ -0,0 +1,118 @@
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+from .instrumentation import get_instrumentation
+
+
+class IdPClient:
+    """
+    Application-scoped HTTP client for identity provider calls.
+
+    One pooled session is shared by all SSO helpers so connections,
+    TLS sessions and DNS lookups are reused between requests.
+    """
+    DEFAULT_LIMIT = 100
+    DEFAULT_LIMIT_PER_HOST = 20
+    DEFAULT_KEEPALIVE_TIMEOUT = 30
+    DEFAULT_DNS_CACHE_TTL = 300
+    DEFAULT_TIMEOUT = 10
+    DEFAULT_CONNECT_TIMEOUT = 3
+
+    def __init__(self,
+                 limit: int = DEFAULT_LIMIT,
+                 limit_per_host: int = DEFAULT_LIMIT_PER_HOST,
+                 keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+                 ttl_dns_cache: int = DEFAULT_DNS_CACHE_TTL,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.timeout = aiohttp.ClientTimeout(total=timeout,
+                                             connect=connect_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._closed = False
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._closed:
+            # A new session after app cleanup would leak its connector
+            raise RuntimeError('IdP client is closed')
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.ttl_dns_cache,
+        )
+        return aiohttp.ClientSession(connector=connector,
+                                     timeout=self.timeout)
+
+    async def start(self) -> None:
+        self._closed = False
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._closed = True
+
+    def request(self, method: str, url: str,
+                timeout: Optional[float] = None, **kwargs):
+        if timeout is not None:
+            # Override the total only, keep connect and socket timeouts
+            kwargs['timeout'] = aiohttp.ClientTimeout(
+                total=timeout,
+                connect=self.timeout.connect,
+                sock_read=self.timeout.sock_read,
+                sock_connect=self.timeout.sock_connect)
+        get_instrumentation().count('idp.request')
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_idp_client: Optional[IdPClient] = None
+
+
+def get_idp_client() -> IdPClient:
+    global _idp_client
+
+    if _idp_client is None:
+        _idp_client = IdPClient()
+    return _idp_client
+
+
+def setup_idp_client(app: web.Application, **kwargs) -> IdPClient:
+    """
+    Register IdP client startup and cleanup on the application
+    """
+    global _idp_client
+
+    client = _idp_client = IdPClient(**kwargs)
+    app['idp_client'] = client
+
+    async def start_idp_client(app):
+        await client.start()
+
+    async def close_idp_client(app):
+        await client.close()
+
+    app.on_startup.append(start_idp_client)
+    app.on_cleanup.append(close_idp_client)
+    return client
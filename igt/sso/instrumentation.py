@@ -0,0 +1,162 @@
+import logging
+import time
+from contextlib import nullcontext
+from functools import wraps
+from typing import Optional
+
+from aiohttp import web
+
+_NULL_STAGE = nullcontext()
+
+
+class Instrumentation:
+    """
+    Stage timers and call counters for the SSO pipeline.
+
+    The base class is a no-op: ``stage`` returns a shared null context
+    and ``count`` does nothing, so disabled instrumentation costs one
+    attribute lookup per hook.
+    """
+    enabled = False
+
+    def stage(self, name: str):
+        return _NULL_STAGE
+
+    def observe(self, stage: str, seconds: float) -> None:
+        pass
+
+    def count(self, name: str, value: int = 1) -> None:
+        pass
+
+
+class _Stage:
+    __slots__ = ('instrumentation', 'name', 'started')
+
+    def __init__(self, instrumentation: Instrumentation, name: str):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.instrumentation.observe(self.name,
+                                     time.perf_counter() - self.started)
+
+
+class _EnabledInstrumentation(Instrumentation):
+    enabled = True
+
+    def stage(self, name: str):
+        return _Stage(self, name)
+
+
+class LoggingInstrumentation(_EnabledInstrumentation):
+    """
+    Emit one structured log record per stage and counter increment
+    """
+
+    def __init__(self, logger: logging.Logger = None,
+                 level: int = logging.DEBUG):
+        self.logger = logger or logging.getLogger('igt.sso.metrics')
+        self.level = level
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self.logger.log(self.level, 'sso stage',
+                        extra={'stage': stage, 'duration': seconds})
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.logger.log(self.level, 'sso counter',
+                        extra={'counter': name, 'value': value})
+
+
+class PrometheusInstrumentation(_EnabledInstrumentation):
+    """
+    Export stages as a histogram and calls as a counter.
+
+    Requires ``prometheus_client``.
+    """
+
+    def __init__(self, namespace: str = 'sso', registry=None):
+        import prometheus_client
+
+        kwargs = {'registry': registry} if registry is not None else {}
+        self.stages = prometheus_client.Histogram(
+            'stage_seconds', 'Time spent in an SSO pipeline stage',
+            ['stage'], namespace=namespace, **kwargs)
+        self.calls = prometheus_client.Counter(
+            'calls', 'Outbound IdP and Redis calls',
+            ['name'], namespace=namespace, **kwargs)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self.stages.labels(stage).observe(seconds)
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.calls.labels(name).inc(value)
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation() -> Instrumentation:
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation: Optional[Instrumentation]) -> None:
+    global _instrumentation
+
+    _instrumentation = instrumentation or Instrumentation()
+
+
+def timed(stage: str):
+    """
+    Time a coroutine function as ``stage`` when instrumentation is enabled
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            instrumentation = _instrumentation
+            if not instrumentation.enabled:
+                return await func(*args, **kwargs)
+            with instrumentation.stage(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedRedis:
+    """
+    Redis proxy counting each command (or MULTI/EXEC) as ``redis.<name>``
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    def __getattr__(self, name):
+        attribute = getattr(self._redis, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        @wraps(attribute)
+        def call(*args, **kwargs):
+            _instrumentation.count(f'redis.{name}')
+            return attribute(*args, **kwargs)
+        return call
+
+
+def setup_instrumentation(app: web.Application,
+                          instrumentation: Instrumentation) -> None:
+    """
+    Enable instrumentation and count calls made through ``app['redis']``.
+
+    Register after the hook that creates ``app['redis']``.
+    """
+    set_instrumentation(instrumentation)
+
+    async def instrument_redis(app):
+        if not isinstance(app['redis'], InstrumentedRedis):
+            app['redis'] = InstrumentedRedis(app['redis'])
+
+    app.on_startup.append(instrument_redis)
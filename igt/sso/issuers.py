@@ -0,0 +1,153 @@
+import base64
+import json
+from typing import Dict, Iterable, Mapping, Optional, Sequence, Union
+
+import jwt
+from yarl import URL
+
+from . import avanpost
+from .batcher import verify_signature
+from .breaker import CircuitBreaker
+from .cache import VerifiedTokenCache
+from .instrumentation import get_instrumentation
+from .jwks import JWKSStore
+from .permissions import PermissionIndex
+from .utils import verify_audience
+
+# Audience is checked against the issuer's audience set after decoding
+_DECODE_OPTIONS = {'verify_aud': False, 'require': ['exp', 'iss']}
+
+
+def unverified_issuer(token: Union[str, bytes]) -> Optional[str]:
+    """
+    Read ``iss`` from the token payload without checking the signature
+    """
+    if isinstance(token, str):
+        token = token.encode('ascii', 'replace')
+    try:
+        _, payload, _ = token.split(b'.')
+        payload += b'=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+    except (ValueError, TypeError):
+        return None
+    issuer = claims.get('iss') if isinstance(claims, dict) else None
+    return issuer if isinstance(issuer, str) else None
+
+
+class IssuerVerifier:
+    """
+    Token verification for one Avanpost realm.
+
+    Each issuer has its own JWKS store, circuit breaker, accepted
+    audiences, permission rules and verified-token cache, and counts its
+    verifications under ``issuer.<name>.*``. An outage of one realm does
+    not open the circuit of the others.
+    """
+
+    def __init__(self,
+                 issuer: str,
+                 audiences: Iterable[str],
+                 jwks_uri: Optional[str] = None,
+                 name: Optional[str] = None,
+                 algorithms: Optional[Sequence[str]] = None,
+                 rules: Optional[Mapping[str, Iterable[str]]] = None,
+                 default_groups: Optional[Iterable[str]] = None,
+                 token_cache: Optional[VerifiedTokenCache] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 ):
+        self.issuer = issuer
+        self.name = name or URL(issuer).host or issuer
+        self.audiences = frozenset(audiences)
+        # Optional allowlist, by default the JWKS decides
+        self.algorithms = frozenset(algorithms) if algorithms else None
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.jwks_store = JWKSStore(jwks_uri or f'{issuer}/oauth2/public_keys',
+                                    breaker=self.breaker)
+        self.permission_index = PermissionIndex(rules, default_groups)
+        self.token_cache = (token_cache if token_cache is not None
+                            else VerifiedTokenCache())
+
+        self._verified_counter = f'issuer.{self.name}.verified'
+        self._failed_counter = f'issuer.{self.name}.failed'
+        self.verified = 0
+        self.failed = 0
+
+    @classmethod
+    def from_settings(cls, **kwargs) -> 'IssuerVerifier':
+        """
+        Verifier for the issuer configured in the ``avanpost`` section
+        """
+        settings = avanpost.get_settings()
+        return cls(settings.issuer,
+                   settings.audiences,
+                   jwks_uri=settings.public_key_url,
+                   **kwargs)
+
+    @property
+    def stats(self) -> Dict[str, object]:
+        return {
+            'verified': self.verified,
+            'failed': self.failed,
+            'jwks': self.jwks_store.stats,
+            'breaker': self.breaker.stats,
+            'cache': self.token_cache.stats,
+        }
+
+    async def verify(self, token: Union[str, bytes]) -> dict:
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+            signing_key = await self.jwks_store.get_signing_key(kid)
+            algorithm = (signing_key.algorithm
+                         or avanpost.DEFAULT_HASH_ALGORITHM)
+            if self.algorithms is not None and (
+                    algorithm not in self.algorithms):
+                raise jwt.InvalidAlgorithmError(
+                    f'Algorithm {algorithm} is not allowed')
+            payload = await verify_signature(token,
+                                             signing_key.key,
+                                             algorithms=[algorithm],
+                                             issuer=self.issuer,
+                                             options=_DECODE_OPTIONS)
+            verify_audience(payload, self.audiences)
+        except jwt.InvalidTokenError:
+            self.failed += 1
+            get_instrumentation().count(self._failed_counter)
+            raise
+        self.verified += 1
+        get_instrumentation().count(self._verified_counter)
+        return payload
+
+
+class IssuerRegistry:
+    """
+    Route tokens to the verifier of their ``iss`` claim.
+
+    The claim is read from the unverified payload, routing is a single
+    dict lookup. Tokens of unknown issuers are rejected before any key
+    lookup.
+    """
+
+    def __init__(self, verifiers: Iterable[IssuerVerifier]):
+        self._verifiers: Dict[str, IssuerVerifier] = {
+            verifier.issuer: verifier for verifier in verifiers
+        }
+
+    def __iter__(self):
+        return iter(self._verifiers.values())
+
+    def __len__(self):
+        return len(self._verifiers)
+
+    def add(self, verifier: IssuerVerifier) -> None:
+        self._verifiers[verifier.issuer] = verifier
+
+    def route(self, token: Union[str, bytes]) -> IssuerVerifier:
+        verifier = self._verifiers.get(unverified_issuer(token))
+        if verifier is None:
+            raise jwt.InvalidIssuerError('Unknown token issuer')
+        return verifier
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        return {verifier.name: verifier.stats
+                for verifier in self._verifiers.values()}
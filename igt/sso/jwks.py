@@ -0,0 +1,247 @@
+import asyncio
+import re
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import jwt.algorithms
+from aiohttp import hdrs
+
+from . import avanpost, log
+from .batcher import offload
+from .breaker import CircuitBreaker, get_circuit_breaker
+from .client import get_idp_client
+
+_MAX_AGE_PATTERN = re.compile(r'max-age\s*=\s*(\d+)', re.IGNORECASE)
+_EC_ALGORITHMS = {'P-256': 'ES256', 'P-384': 'ES384', 'P-521': 'ES512'}
+
+
+class SigningKey(NamedTuple):
+    key: object
+    # None for RSA keys published without ``alg``
+    algorithm: Optional[str]
+
+
+def parse_max_age(cache_control: Optional[str],
+                  default: float,
+                  minimum: float = 0) -> float:
+    """
+    Return freshness lifetime in seconds from a Cache-Control header,
+    but not less than ``minimum``
+    """
+    if not cache_control:
+        return max(default, minimum)
+    directives = cache_control.lower()
+    if 'no-store' in directives or 'no-cache' in directives:
+        return minimum
+    match = _MAX_AGE_PATTERN.search(cache_control)
+    return max(int(match.group(1)) if match else default, minimum)
+
+
+class JWKSStore:
+    """
+    In-process store of issuer public keys indexed by ``kid``.
+
+    Keys are parsed once per JWKS download. The store honours the
+    issuer's ``Cache-Control: max-age``, but keeps keys for at least
+    ``min_max_age`` seconds even when the issuer forbids caching, so
+    ``no-cache`` does not turn every request into a download. It starts
+    a background refresh once ``refresh_ahead`` of the lifetime has
+    passed and refetches on an unknown ``kid`` at most once per
+    ``unknown_kid_cooldown`` seconds.
+
+    When the issuer cannot be reached, expired keys keep verifying
+    signatures for up to ``stale_grace`` seconds after expiry. Downloads
+    go through ``breaker``, the shared IdP circuit breaker by default.
+    """
+    DEFAULT_MAX_AGE = 300
+    MIN_MAX_AGE = 30
+    REFRESH_AHEAD = 0.8
+    UNKNOWN_KID_COOLDOWN = 30
+
+    def __init__(self,
+                 jwks_uri: Optional[str] = None,
+                 default_max_age: float = DEFAULT_MAX_AGE,
+                 min_max_age: float = MIN_MAX_AGE,
+                 refresh_ahead: float = REFRESH_AHEAD,
+                 unknown_kid_cooldown: float = UNKNOWN_KID_COOLDOWN,
+                 stale_grace: Optional[float] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 ):
+        self._jwks_uri = jwks_uri
+        self._breaker = breaker
+        self.default_max_age = default_max_age
+        self.min_max_age = min_max_age
+        self.refresh_ahead = refresh_ahead
+        self.unknown_kid_cooldown = unknown_kid_cooldown
+        self._stale_grace = stale_grace
+
+        self._keys: Dict[str, object] = {}
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._last_unknown_kid_fetch = float('-inf')
+        self._generation = 0
+        self._refresh_error: Optional[Exception] = None
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        # Host-wide SharedMemoryTable, see setup_shared_cache
+        self.shared = None
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.stale_hits = 0
+
+    @property
+    def jwks_uri(self) -> str:
+        return self._jwks_uri or avanpost.PUBLIC_KEY_URL
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return self._breaker or get_circuit_breaker()
+
+    @property
+    def stale_grace(self) -> float:
+        if self._stale_grace is None:
+            return avanpost.JWKS_STALE_GRACE
+        return self._stale_grace
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_failures': self.refresh_failures,
+            'stale_hits': self.stale_hits,
+            'keys': len(self._keys),
+        }
+
+    async def get_key(self, kid: str):
+        return (await self.get_signing_key(kid)).key
+
+    async def get_signing_key(self, kid: str) -> SigningKey:
+        now = time.monotonic()
+        if now >= self._expires_at:
+            await self._refresh_or_go_stale(now)
+        elif now >= self._refresh_at:
+            self._schedule_refresh()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        if now - self._last_unknown_kid_fetch >= self.unknown_kid_cooldown:
+            self._last_unknown_kid_fetch = now
+            try:
+                await self.refresh(force=True)
+            except Exception as e:
+                self.refresh_failures += 1
+                log.debug('jwks refresh failed', error=e)
+            key = self._keys.get(kid)
+
+        if key is None:
+            raise jwt.InvalidTokenError(f'Unknown signing key id: {kid}')
+        return key
+
+    async def _refresh_or_go_stale(self, now: float) -> None:
+        try:
+            await self.refresh()
+        except Exception as e:
+            self.refresh_failures += 1
+            if not self._keys or now >= self._expires_at + self.stale_grace:
+                raise
+            self.stale_hits += 1
+            log.debug('jwks refresh failed, using stale keys', error=e)
+
+    async def refresh(self, force=False) -> None:
+        generation = self._generation
+        async with self._lock:
+            # Another coroutine attempted a refresh while we were waiting,
+            # share its outcome instead of queueing on a failing issuer
+            if self._generation != generation:
+                if self._refresh_error is not None:
+                    raise self._refresh_error
+                return
+            if not force and time.monotonic() < self._refresh_at:
+                return
+            try:
+                jwks, max_age = await self._fetch(force)
+            except Exception as e:
+                self._refresh_error = e
+                self._generation += 1
+                raise
+            self._refresh_error = None
+            # Building RSA key objects is CPU-bound as well
+            self._keys = await offload(self._parse, jwks)
+            now = time.monotonic()
+            self._expires_at = now + max_age
+            self._refresh_at = now + max_age * self.refresh_ahead
+            self._generation += 1
+            self.refreshes += 1
+
+    def _schedule_refresh(self) -> None:
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        self._refresh_task = asyncio.ensure_future(self._background_refresh())
+
+    async def _background_refresh(self) -> None:
+        try:
+            await self.refresh()
+        except Exception as e:
+            # Keys stay valid until expiry, next request will retry
+            self.refresh_failures += 1
+            log.debug('background jwks refresh failed', error=e)
+
+    async def _fetch(self, force=False) -> Tuple[Dict, float]:
+        shared = self.shared
+        if shared is not None and not force:
+            # Another worker on this host has downloaded the keys. A copy
+            # already inside its refresh-ahead window would be served by
+            # every worker until expiry, fetch and republish it instead
+            cached = shared.get_jwks()
+            if cached is not None:
+                jwks, max_age, lifetime = cached
+                if max_age > lifetime * (1 - self.refresh_ahead):
+                    return jwks, max_age
+        jwks, max_age = await self.breaker.call(self._download)
+        if shared is not None and max_age > 0:
+            shared.set_jwks(jwks, max_age)
+        return jwks, max_age
+
+    async def _download(self) -> Tuple[Dict, float]:
+        async with get_idp_client().get(url=self.jwks_uri) as response:
+            response.raise_for_status()
+            max_age = parse_max_age(response.headers.get(hdrs.CACHE_CONTROL),
+                                    self.default_max_age, self.min_max_age)
+            return await response.json(), max_age
+
+    @staticmethod
+    def _parse(jwks: Dict) -> Dict[str, SigningKey]:
+        """
+        Build key objects once per download, paired with the algorithm
+        they verify: ``alg`` if published, otherwise implied by the curve
+        """
+        keys = {}
+        for jwk in jwks['keys']:
+            if jwk.get('use', 'sig') != 'sig':
+                continue
+            kty, algorithm = jwk.get('kty'), jwk.get('alg')
+            try:
+                if kty == 'RSA':
+                    key = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+                elif kty == 'EC':
+                    key = jwt.algorithms.ECAlgorithm.from_jwk(jwk)
+                    algorithm = algorithm or _EC_ALGORITHMS.get(jwk.get('crv'))
+                elif kty == 'OKP':
+                    key = jwt.algorithms.OKPAlgorithm.from_jwk(jwk)
+                    algorithm = 'EdDSA'
+                else:
+                    continue
+            except jwt.InvalidKeyError as e:
+                log.debug('skipping invalid jwk', kid=jwk.get('kid'), error=e)
+                continue
+            keys[jwk['kid']] = SigningKey(key, algorithm)
+        return keys
@@ -0,0 +1,124 @@
+"""
+Structured debug logging for the SSO package.
+
+``log.debug('event', key=value, ...)`` costs one level check when debug
+is off. When it is on, values are redacted into a snapshot on the
+calling side and rendered to text only by the handler. With
+``setup_logging`` records are rendered and written on a listener
+thread, so log I/O never runs on the event loop.
+"""
+import logging
+import logging.handlers
+import queue
+from typing import Iterable, Mapping, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger('igt.sso')
+
+SENSITIVE_KEYS = frozenset({
+    'access_token', 'refresh_token', 'id_token', 'token', 'code',
+    'code_verifier', 'state', 'client_secret', 'authorization', 'cookie',
+    'set-cookie',
+})
+MAX_VALUE_LENGTH = 200
+_VISIBLE_PREFIX = 6
+
+
+def _mask(value) -> str:
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    text = str(value)
+    # Enough of a prefix to correlate records, never the whole secret
+    return f"{text[:_VISIBLE_PREFIX]}...({len(text)})"
+
+
+def redact(value, key: Optional[str] = None):
+    """
+    Copy ``value`` with secrets masked and long strings truncated
+    """
+    if value is None:
+        return None
+    if key is not None and key.lower() in SENSITIVE_KEYS:
+        return _mask(value)
+    if isinstance(value, Mapping):
+        return {k: redact(v, str(k)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, (bool, int, float)):
+        return value
+    text = repr(value) if isinstance(value, BaseException) else str(value)
+    if len(text) > MAX_VALUE_LENGTH:
+        return f"{text[:MAX_VALUE_LENGTH]}...({len(text)})"
+    return text
+
+
+class Fields:
+    """
+    Redacted record fields, rendered as ``key=value`` on ``str()``
+    """
+    __slots__ = ('fields',)
+
+    def __init__(self, fields: dict):
+        self.fields = {key: redact(value, key)
+                       for key, value in fields.items()}
+
+    def __str__(self):
+        return ' '.join(f'{key}={value!r}'
+                        for key, value in self.fields.items())
+
+
+def debug(event: str, **fields) -> None:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s %s', event, Fields(fields),
+                     extra={'event': event})
+
+
+def is_debug_enabled() -> bool:
+    return logger.isEnabledFor(logging.DEBUG)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueue records without formatting them.
+
+    ``QueueHandler.prepare`` renders the message in the logging thread.
+    SSO records carry immutable ``Fields`` snapshots, so rendering is
+    left to the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # Tracebacks reference live frames, render them now
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(app: web.Application,
+                  handlers: Iterable[logging.Handler] = (),
+                  level: int = logging.DEBUG,
+                  ) -> logging.handlers.QueueListener:
+    """
+    Route ``igt.sso`` records through a queue to ``handlers``.
+
+    Without handlers records go to stderr.
+    """
+    handlers = tuple(handlers) or (logging.StreamHandler(),)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    queue_handler = DeferredQueueHandler(records)
+
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    listener.start()
+
+    async def stop_logging(app):
+        logger.removeHandler(queue_handler)
+        listener.stop()
+
+    app.on_cleanup.append(stop_logging)
+    return listener
@@ -0,0 +1,102 @@
+"""
+Event loop lag guard for the SSO endpoints.
+
+Set up the guard in strict mode on the gateway app used by integration
+tests or the benchmark harness (``--loop-guard``)::
+
+    setup_loop_lag_guard(app, threshold=0.05, strict=True)
+
+``BlockingCallDetected`` is then raised on app cleanup if ``login``,
+``sso_callback``, ``refresh_tokens`` or ``logout`` blocked the loop, so
+a synchronous call sneaking back in fails the run. Outside strict mode
+lag beyond the threshold is only logged.
+"""
+import asyncio
+import time
+from typing import List, Optional
+
+from aiohttp import web
+
+import gateway_logger
+
+
+class BlockingCallDetected(RuntimeError):
+    pass
+
+
+class LoopLagGuard:
+    """
+    Measure event loop lag by scheduling a periodic wake-up.
+
+    A wake-up arriving later than ``threshold`` seconds means something
+    blocked the loop, e.g. a synchronous HTTP call in an SSO handler.
+    With ``strict`` enabled ``stop`` raises :class:`BlockingCallDetected`
+    so tests fail when a blocking call sneaks back in.
+    """
+    DEFAULT_INTERVAL = 0.05
+    DEFAULT_THRESHOLD = 0.1
+
+    def __init__(self,
+                 interval: float = DEFAULT_INTERVAL,
+                 threshold: float = DEFAULT_THRESHOLD,
+                 strict: bool = False,
+                 ):
+        self.interval = interval
+        self.threshold = threshold
+        self.strict = strict
+        self.max_lag = 0.0
+        self.violations: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.check()
+
+    def check(self) -> None:
+        if self.strict and self.violations:
+            raise BlockingCallDetected(
+                f'Event loop was blocked {len(self.violations)} times, '
+                f'max lag {self.max_lag:.3f}s')
+
+    async def _watch(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - expected
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.violations.append(lag)
+                gateway_logger.warning(
+                    f"Event loop blocked for {lag:.3f}s")
+
+
+def setup_loop_lag_guard(app: web.Application, **kwargs) -> LoopLagGuard:
+    guard = LoopLagGuard(**kwargs)
+    app['loop_lag_guard'] = guard
+
+    async def start_loop_lag_guard(app):
+        guard.start()
+
+    async def stop_loop_lag_guard(app):
+        await guard.stop()
+
+    app.on_startup.append(start_loop_lag_guard)
+    app.on_cleanup.append(stop_loop_lag_guard)
+    return guard
@@ -4,8 +4,13 @@ from functools import partial
 import jwt
 from aiohttp import web, hdrs
 
-from ..aiohttp_jwt.utils import invoke, check_request
-from ..sso.utils import has_permissions, decode_avanpost_jwt
+from ..aiohttp_jwt.utils import invoke
+from ..sso.batcher import VerifierSaturatedError
+from ..sso.breaker import CircuitOpenError
+from ..sso.instrumentation import get_instrumentation
+from ..sso.permissions import PermissionIndex
+from ..sso.utils import decode_avanpost_jwt
+from ..sso.whitelist import WhitelistMatcher
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +26,9 @@ def AvanpostJWTMiddleware(
         is_revoked=None,
         store_token=False,
         auth_schema='Bearer',
+        token_cache=None,
+        permission_index=None,
+        issuers=None,
 ):
     if not (signing_key and isinstance(signing_key, str)):
         raise RuntimeError(
@@ -34,34 +42,84 @@ def AvanpostJWTMiddleware(
 
     _request_property = request_property
 
+    if permission_index is None:
+        permission_index = PermissionIndex()
+
+    is_whitelisted = WhitelistMatcher(whitelist)
+
     @web.middleware
     async def jwt_middleware(request, handler):
         if request.method == hdrs.METH_OPTIONS:
             return await handler(request)
 
-        if check_request(request, whitelist):
+        if is_whitelisted(request):
             return await handler(request)
 
-        token = await invoke(partial(token_getter, request))
+        instrumentation = get_instrumentation()
+
+        with instrumentation.stage('token_extraction'):
+            token = await invoke(partial(token_getter, request))
 
         if not token:
             raise web.HTTPUnauthorized(
                 reason='Missing authorization token',
             )
 
-        try:
-            decoded = await decode_avanpost_jwt(token)
-        except jwt.InvalidTokenError as exc:
-            msg = 'Invalid authorization token, ' + str(exc)
-            raise web.HTTPUnauthorized(reason=msg)
-
-        if (callable(is_revoked)
-                and await invoke(partial(is_revoked, request, token))):
+        if issuers is None:
+            cache, index, verify = (token_cache, permission_index,
+                                    decode_avanpost_jwt)
+        else:
+            try:
+                verifier = issuers.route(token)
+            except jwt.InvalidTokenError as exc:
+                msg = 'Invalid authorization token, ' + str(exc)
+                raise web.HTTPUnauthorized(reason=msg)
+            cache, index, verify = (verifier.token_cache,
+                                    verifier.permission_index,
+                                    verifier.verify)
+
+        cached = cache.get(token) if cache is not None else None
+
+        if cached is None:
+            instrumentation.count('token_cache.miss')
+            try:
+                with instrumentation.stage('verification'):
+                    decoded = await verify(token)
+            except jwt.InvalidTokenError as exc:
+                msg = 'Invalid authorization token, ' + str(exc)
+                raise web.HTTPUnauthorized(reason=msg)
+            except CircuitOpenError:
+                raise web.HTTPServiceUnavailable(
+                    reason='Identity provider is unavailable',
+                )
+            except VerifierSaturatedError:
+                raise web.HTTPServiceUnavailable(
+                    reason='Token verification is saturated',
+                    headers={hdrs.RETRY_AFTER: '1'},
+                )
+            groups_mask = None
+        else:
+            instrumentation.count('token_cache.hit')
+            decoded, groups_mask = cached.payload, cached.groups_mask
+
+        with instrumentation.stage('revocation'):
+            revoked = (callable(is_revoked)
+                       and await invoke(partial(is_revoked, request, token)))
+        if revoked:
+            if cache is not None:
+                cache.invalidate(token)
             raise web.HTTPForbidden(reason='Token is revoked')
 
+        with instrumentation.stage('permission'):
+            if groups_mask is None:
+                groups_mask = index.groups_mask(decoded)
+                if cache is not None:
+                    cache.set(token, decoded, groups_mask)
+            permitted = index.is_permitted(groups_mask, request)
+
         request[request_property] = decoded
 
-        if not await has_permissions(decoded):
+        if not permitted:
             reason = "You have no rights to access the page."
             raise web.HTTPForbidden(reason=reason)
 
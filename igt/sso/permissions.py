@@ -0,0 +1,59 @@
+from typing import Dict, Iterable, Mapping, Optional
+
+from aiohttp import web
+
+from . import avanpost
+
+
+class PermissionIndex:
+    """
+    Route-level authorization rules compiled into bitmasks.
+
+    Every group name mentioned in the rules gets a bit, every route
+    canonical path maps to the mask of groups allowed to call it. A token
+    is converted into a mask once (and cached with the verified token),
+    after which each check is a dict lookup and a bitwise AND.
+    """
+
+    def __init__(self,
+                 rules: Optional[Mapping[str, Iterable[str]]] = None,
+                 default_groups: Iterable[str] = None,
+                 ):
+        if default_groups is None:
+            default_groups = (avanpost.PARMA_ML_GROUP_NAME,)
+        rules = dict(rules or {})
+
+        group_names = set(default_groups)
+        for groups in rules.values():
+            group_names.update(groups)
+        self._bits: Dict[str, int] = {
+            name: 1 << bit for bit, name in enumerate(sorted(group_names))
+        }
+        self._default_mask = self._compile(default_groups)
+        self._route_masks: Dict[str, int] = {
+            route: self._compile(groups) for route, groups in rules.items()
+        }
+
+    def _compile(self, groups: Iterable[str]) -> int:
+        mask = 0
+        for name in groups:
+            mask |= self._bits[name]
+        return mask
+
+    def groups_mask(self, payload: dict) -> int:
+        mask = 0
+        for group in payload.get('groups') or ():
+            mask |= self._bits.get(group.get('name'), 0)
+        return mask
+
+    def required_mask(self, request: web.Request) -> int:
+        route = request.match_info.route
+        resource = route.resource if route is not None else None
+        if resource is None:
+            return self._default_mask
+        return self._route_masks.get(resource.canonical, self._default_mask)
+
+    def is_permitted(self, groups_mask: int, request: web.Request) -> bool:
+        required = self.required_mask(request)
+        # Route without any required group is open to every valid token
+        return not required or bool(groups_mask & required)
@@ -0,0 +1,237 @@
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import time
+from typing import Dict, NamedTuple, Optional
+
+import aioredis
+from aiohttp import web
+
+import gateway_logger
+from . import avanpost
+
+# Multiples of 3 bytes encode to base64 without padding
+_STATE_BYTES = 24
+_VERIFIER_BYTES = 42
+_STATE_LENGTH = _STATE_BYTES // 3 * 4
+_CLIENT_BYTES = 18
+_CLIENT_PATTERN = re.compile(r'[A-Za-z0-9_-]{%d}' % (_CLIENT_BYTES // 3 * 4))
+
+LOGIN_COOKIE_NAME = 'sso_login'
+
+
+class PKCEMaterial(NamedTuple):
+    state: str
+    code_verifier: str
+    code_challenge: str
+
+
+def generate_pkce() -> PKCEMaterial:
+    """
+    Return OAuth state, a 56 character code verifier and its S256
+    challenge from a single ``os.urandom`` call
+    """
+    encoded = base64.urlsafe_b64encode(
+        os.urandom(_STATE_BYTES + _VERIFIER_BYTES))
+    state, code_verifier = encoded[:_STATE_LENGTH], encoded[_STATE_LENGTH:]
+    challenge = base64.urlsafe_b64encode(
+        hashlib.sha256(code_verifier).digest())
+    return PKCEMaterial(state.decode('ascii'),
+                        code_verifier.decode('ascii'),
+                        challenge[:-1].decode('ascii'))
+
+
+class PKCEStateStore:
+    """
+    Expiring store of PKCE code verifiers keyed by OAuth state.
+
+    Verifiers are written with a TTL so abandoned logins do not leak
+    keys. Outstanding states of a client, a browser identified by the
+    pre-login cookie, are indexed in a sorted set scored by creation
+    time; once a client has more than ``max_states_per_client`` of them
+    the oldest ones are evicted. Consumed states leave the index.
+
+    Every outstanding state is also kept in a single global index, the
+    sweeper trims expired ones from it and counts the rest instead of
+    scanning the per-client indexes.
+    """
+    STATES_INDEX_REDIS_KEY = 'forest:sso:avanpost:pending_states'
+    CLIENT_INDEX_REDIS_KEY = 'forest:sso:avanpost:pending_states:{client}'
+    SWEEP_INTERVAL = 300
+
+    def __init__(self,
+                 ttl: Optional[int] = None,
+                 max_states_per_client: Optional[int] = None,
+                 ):
+        self._ttl = ttl
+        self._max_states_per_client = max_states_per_client
+        self._sweeper: Optional[asyncio.Task] = None
+
+        self.saved = 0
+        self.consumed = 0
+        self.evicted = 0
+        self.live_states = 0
+
+    @property
+    def ttl(self) -> int:
+        if self._ttl is None:
+            return avanpost.CODE_VERIFIER_TTL
+        return self._ttl
+
+    @property
+    def max_states_per_client(self) -> int:
+        if self._max_states_per_client is None:
+            return avanpost.PKCE_STATES_PER_CLIENT
+        return self._max_states_per_client
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'saved': self.saved,
+            'consumed': self.consumed,
+            'evicted': self.evicted,
+            'live_states': self.live_states,
+        }
+
+    @staticmethod
+    def verifier_key(state: str) -> str:
+        return avanpost.CODE_VERIFIER_REDIS_KEY.format(state=state)
+
+    async def save(self, redis_conn: aioredis.Redis, state: str,
+                   code_verifier: str, client: Optional[str] = None) -> None:
+        ttl, now = self.ttl, time.time()
+        transaction = redis_conn.multi_exec()
+        transaction.set(self.verifier_key(state), code_verifier,
+                        expire=ttl)
+        transaction.zadd(self.STATES_INDEX_REDIS_KEY, now, state)
+        if client is None:
+            await transaction.execute()
+            self.saved += 1
+            return
+
+        index_key = self.CLIENT_INDEX_REDIS_KEY.format(client=client)
+        transaction.zremrangebyscore(index_key, max=now - ttl)
+        transaction.zadd(index_key, now, state)
+        transaction.expire(index_key, ttl)
+        transaction.zcard(index_key)
+        *_, outstanding = await transaction.execute()
+        self.saved += 1
+
+        excess = outstanding - self.max_states_per_client
+        if excess > 0:
+            await self._evict(redis_conn, index_key, excess)
+
+    async def _evict(self, redis_conn, index_key: str, count: int) -> None:
+        evicted = await redis_conn.zpopmin(index_key, count,
+                                           encoding='utf-8')
+        # ZPOPMIN replies with a flat member, score list
+        states = evicted[::2]
+        if states:
+            transaction = redis_conn.multi_exec()
+            transaction.delete(*map(self.verifier_key, states))
+            transaction.zrem(self.STATES_INDEX_REDIS_KEY, *states)
+            await transaction.execute()
+            self.evicted += len(states)
+
+    async def pop(self, redis_conn: aioredis.Redis,
+                  state: str, client: Optional[str] = None
+                  ) -> Optional[str]:
+        """
+        Read and delete code verifier atomically (GETDEL)
+        """
+        if not state:
+            return None
+        key = self.verifier_key(state)
+        transaction = redis_conn.multi_exec()
+        transaction.get(key, encoding='utf-8')
+        transaction.delete(key)
+        transaction.zrem(self.STATES_INDEX_REDIS_KEY, state)
+        if client is not None:
+            transaction.zrem(self.CLIENT_INDEX_REDIS_KEY.format(
+                client=client), state)
+        code_verifier, *_ = await transaction.execute()
+        if code_verifier is not None:
+            self.consumed += 1
+        return code_verifier
+
+    async def sweep(self, redis_conn: aioredis.Redis) -> None:
+        """
+        Trim expired states from the global index and count live ones.
+        Client indexes expire on their own.
+        """
+        transaction = redis_conn.multi_exec()
+        transaction.zremrangebyscore(self.STATES_INDEX_REDIS_KEY,
+                                     max=time.time() - self.ttl)
+        transaction.zcard(self.STATES_INDEX_REDIS_KEY)
+        _, self.live_states = await transaction.execute()
+
+    def start(self, redis_conn: aioredis.Redis,
+              interval: float = SWEEP_INTERVAL) -> None:
+        self._sweeper = asyncio.ensure_future(
+            self._sweep_periodically(redis_conn, interval))
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    async def _sweep_periodically(self, redis_conn, interval) -> None:
+        while True:
+            try:
+                await self.sweep(redis_conn)
+            except aioredis.RedisError as e:
+                gateway_logger.warning(f"PKCE state sweep failed: {e!r}")
+            await asyncio.sleep(interval)
+
+
+def client_key(request: web.Request) -> Optional[str]:
+    """
+    Client ID from the pre-login cookie, if the browser carries one
+    """
+    client = request.cookies.get(LOGIN_COOKIE_NAME)
+    if client is None or not _CLIENT_PATTERN.fullmatch(client):
+        return None
+    return client
+
+
+def bind_client(request: web.Request,
+                response: web.StreamResponse) -> str:
+    """
+    Return the client ID of the browser, issuing the pre-login cookie
+    on its first login.
+
+    Remote addresses are shared by every user behind a load balancer
+    or NAT, the cookie keeps per-client state caps per browser.
+    """
+    client = client_key(request)
+    if client is None:
+        client = base64.urlsafe_b64encode(
+            os.urandom(_CLIENT_BYTES)).decode('ascii')
+        response.set_cookie(LOGIN_COOKIE_NAME, client,
+                            httponly=True,
+                            secure=True,
+                            samesite='Lax')
+    return client
+
+
+def setup_pkce_sweeper(app: web.Application,
+                       store: Optional[PKCEStateStore] = None,
+                       interval: float = PKCEStateStore.SWEEP_INTERVAL
+                       ) -> PKCEStateStore:
+    if store is None:
+        from .utils import pkce_store as store
+
+    app['pkce_store'] = store
+
+    async def start_pkce_sweeper(app):
+        store.start(app['redis'], interval)
+
+    async def stop_pkce_sweeper(app):
+        await store.stop()
+
+    app.on_startup.append(start_pkce_sweeper)
+    app.on_cleanup.append(stop_pkce_sweeper)
+    return store
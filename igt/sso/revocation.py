@@ -0,0 +1,205 @@
+import asyncio
+import math
+import time
+from typing import Optional, Union
+
+import aioredis
+from aiohttp import web
+
+import gateway_logger
+from .cache import token_digest
+
+REVOKED_REDIS_KEY = 'forest:sso:revoked:{digest}'
+# Revoked digests scored by expiry, for filter rebuilds without SCAN
+REVOKED_INDEX_REDIS_KEY = 'forest:sso:revocations'
+REVOKED_CHANNEL = 'forest:sso:revoked'
+DEFAULT_REVOKED_TTL = 3600
+
+
+def revoked_key(digest: bytes) -> str:
+    return REVOKED_REDIS_KEY.format(digest=digest.hex())
+
+
+async def revoke_token(redis_conn: aioredis.Redis,
+                       token: Union[str, bytes],
+                       expires_at: Optional[float] = None,
+                       default_ttl: int = DEFAULT_REVOKED_TTL) -> None:
+    """
+    Mark token revoked until its expiry and notify all workers
+    """
+    if expires_at is None:
+        expires_at = time.time() + default_ttl
+    ttl = max(1, int(expires_at - time.time()))
+    digest = token_digest(token)
+
+    transaction = redis_conn.multi_exec()
+    transaction.set(revoked_key(digest), '1', expire=ttl)
+    transaction.zadd(REVOKED_INDEX_REDIS_KEY, expires_at, digest.hex())
+    transaction.publish(REVOKED_CHANNEL, digest.hex())
+    await transaction.execute()
+
+
+class BloomFilter:
+    """
+    Fixed-size bloom filter over SHA-256 digests.
+
+    Bit positions come from double hashing of the digest halves, so no
+    additional hashing is done per lookup.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate)
+                               / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest: bytes):
+        first = int.from_bytes(digest[:16], 'big')
+        second = int.from_bytes(digest[16:], 'big') | 1
+        return ((first + i * second) % self.size
+                for i in range(self.hash_count))
+
+    def add(self, digest: bytes) -> None:
+        for position in self._positions(digest):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(digest))
+
+
+class RevocationRegistry:
+    """
+    Two-tier revocation check.
+
+    Every worker keeps a bloom filter of revoked token digests. Redis is
+    consulted only on a filter hit, so valid tokens cost no round trips.
+    Revocations written by ``revoke_token`` are broadcast over pub/sub
+    and the filter is rebuilt from the revocation index every
+    ``resync_interval`` seconds, which bounds propagation delay even if
+    a pub/sub message is lost.
+    """
+    REVOKED_REDIS_KEY = REVOKED_REDIS_KEY
+    REVOKED_CHANNEL = REVOKED_CHANNEL
+    DEFAULT_CAPACITY = 100_000
+    RESYNC_INTERVAL = 60
+
+    def __init__(self,
+                 capacity: int = DEFAULT_CAPACITY,
+                 error_rate: float = 0.001,
+                 resync_interval: float = RESYNC_INTERVAL,
+                 ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.resync_interval = resync_interval
+        self._filter = BloomFilter(capacity, error_rate)
+        self._rebuilding: Optional[BloomFilter] = None
+        self._tasks = []
+
+        self.checks = 0
+        self.filter_hits = 0
+        self.redis_hits = 0
+        self.resyncs = 0
+
+    @property
+    def stats(self):
+        return {
+            'checks': self.checks,
+            'filter_hits': self.filter_hits,
+            'redis_hits': self.redis_hits,
+            'false_positives': self.filter_hits - self.redis_hits,
+            'resyncs': self.resyncs,
+            'filter_size': self._filter.count,
+        }
+
+    async def is_revoked(self, redis_conn: aioredis.Redis,
+                         token: Union[str, bytes]) -> bool:
+        self.checks += 1
+        digest = token_digest(token)
+        if digest not in self._filter:
+            return False
+        self.filter_hits += 1
+        if await redis_conn.exists(revoked_key(digest)):
+            self.redis_hits += 1
+            return True
+        return False
+
+    def add(self, token: Union[str, bytes]) -> None:
+        """
+        Add a token revoked with ``revoke_token`` to the local filter
+        without waiting for the broadcast
+        """
+        self._add(token_digest(token))
+
+    def _add(self, digest: bytes) -> None:
+        self._filter.add(digest)
+        # Keep revocations that arrive while the filter is being rebuilt
+        if self._rebuilding is not None:
+            self._rebuilding.add(digest)
+
+    async def start(self, redis_conn: aioredis.Redis) -> None:
+        channel, = await redis_conn.subscribe(self.REVOKED_CHANNEL)
+        await self.resync(redis_conn)
+        self._tasks = [
+            asyncio.ensure_future(self._listen(channel)),
+            asyncio.ensure_future(self._resync_periodically(redis_conn)),
+        ]
+
+    async def stop(self, redis_conn: aioredis.Redis) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await redis_conn.unsubscribe(self.REVOKED_CHANNEL)
+
+    async def resync(self, redis_conn: aioredis.Redis) -> None:
+        """
+        Rebuild the filter from Redis, dropping expired revocations
+        """
+        bloom_filter = self._rebuilding = BloomFilter(self.capacity,
+                                                      self.error_rate)
+        now = time.time()
+        try:
+            transaction = redis_conn.multi_exec()
+            transaction.zremrangebyscore(REVOKED_INDEX_REDIS_KEY, max=now)
+            transaction.zrangebyscore(REVOKED_INDEX_REDIS_KEY, min=now,
+                                      encoding='utf-8')
+            _, digests = await transaction.execute()
+            for digest in digests:
+                bloom_filter.add(bytes.fromhex(digest))
+        finally:
+            self._rebuilding = None
+        self._filter = bloom_filter
+        self.resyncs += 1
+
+    async def _listen(self, channel) -> None:
+        while await channel.wait_message():
+            digest = await channel.get(encoding='utf-8')
+            self._add(bytes.fromhex(digest))
+
+    async def _resync_periodically(self, redis_conn) -> None:
+        while True:
+            await asyncio.sleep(self.resync_interval)
+            try:
+                await self.resync(redis_conn)
+            except aioredis.RedisError as e:
+                gateway_logger.warning(f"Revocation resync failed: {e!r}")
+
+
+def setup_revocation(app: web.Application, **kwargs) -> RevocationRegistry:
+    registry = RevocationRegistry(**kwargs)
+    app['revocation'] = registry
+
+    async def start_revocation(app):
+        await registry.start(app['redis'])
+
+    async def stop_revocation(app):
+        await registry.stop(app['redis'])
+
+    app.on_startup.append(start_revocation)
+    app.on_cleanup.append(stop_revocation)
+    return registry
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Optional
+
+import aioredis
+from aiohttp import web
+
+import gateway_logger
+
+if TYPE_CHECKING:
+    from .sessions import RedisSessionStore
+
+
+class RateLimiter:
+    """
+    Token bucket allowing ``rate`` acquisitions per second
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens
+                               + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RefreshScheduler:
+    """
+    Refresh access tokens shortly before they expire.
+
+    ``RedisSessionStore`` schedules every session ID in a Redis sorted set
+    scored by access token expiry. Each worker polls for sessions due
+    within ``lead_time``, claims them with ZREM so only one worker
+    refreshes a session and refreshes in batches under an IdP rate
+    limit. Only sessions the client used within ``idle_timeout`` are
+    refreshed, idle ones fall back to refresh on demand.
+
+    The rotated pair replaces the session in the same MULTI/EXEC and is
+    kept under the session the client still holds tokens of, for at
+    most ``rotated_ttl`` seconds, where ``refresh_tokens`` picks it up
+    without calling the IdP and ``logout`` finds the current session.
+    """
+    SCHEDULE_REDIS_KEY = 'forest:sso:refresh:schedule'
+    ROTATED_REDIS_KEY = 'forest:sso:refresh:rotated:{session_id}'
+    LEAD_TIME = 30
+    INTERVAL = 5
+    BATCH_SIZE = 100
+    RATE = 10
+    IDLE_TIMEOUT = 3600
+    ROTATED_TTL = 24 * 3600
+
+    def __init__(self,
+                 lead_time: float = LEAD_TIME,
+                 interval: float = INTERVAL,
+                 batch_size: int = BATCH_SIZE,
+                 rate: float = RATE,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 rotated_ttl: int = ROTATED_TTL,
+                 ):
+        self.lead_time = lead_time
+        self.interval = interval
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.rotated_ttl = rotated_ttl
+        self.limiter = RateLimiter(rate, burst=max(1, int(rate)))
+        self._sessions: Optional['RedisSessionStore'] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.refreshed = 0
+        self.failed = 0
+        self.idle = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'refreshed': self.refreshed, 'failed': self.failed,
+                'idle': self.idle}
+
+    @classmethod
+    def rotated_key(cls, sid: str) -> str:
+        return cls.ROTATED_REDIS_KEY.format(session_id=sid)
+
+    def schedule(self, transaction, sid: str, expires_in) -> None:
+        """
+        Queue session for refresh as part of a MULTI/EXEC
+        """
+        if expires_in:
+            transaction.zadd(self.SCHEDULE_REDIS_KEY,
+                             time.time() + expires_in, sid)
+
+    def start(self, redis_conn: aioredis.Redis,
+              refresh: Callable[..., Awaitable[Dict]],
+              sessions: 'RedisSessionStore') -> None:
+        self._sessions = sessions
+        self._task = asyncio.ensure_future(self._run(redis_conn, refresh))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, redis_conn, refresh) -> None:
+        while True:
+            try:
+                while await self.refresh_due(redis_conn, refresh):
+                    pass
+            except Exception as e:
+                gateway_logger.warning(f"Refresh scheduler failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+    async def refresh_due(self, redis_conn, refresh) -> int:
+        """
+        Refresh one batch of due tokens, return the batch size
+        """
+        due = await redis_conn.zrangebyscore(
+            self.SCHEDULE_REDIS_KEY, max=time.time() + self.lead_time,
+            offset=0, count=self.batch_size, encoding='utf-8')
+        if not due:
+            return 0
+        await asyncio.gather(*(self._refresh_one(redis_conn, sid, refresh)
+                               for sid in due),
+                             return_exceptions=True)
+        return len(due)
+
+    async def _refresh_one(self, redis_conn, sid, refresh) -> None:
+        try:
+            await self._refresh_session(redis_conn, sid, refresh)
+        except Exception as e:
+            self.failed += 1
+            gateway_logger.warning(
+                f"Proactive token refresh of session {sid} failed: {e!r}")
+
+    async def _refresh_session(self, redis_conn, sid, refresh) -> None:
+        # Another worker claimed the session first
+        if not await redis_conn.zrem(self.SCHEDULE_REDIS_KEY, sid):
+            return
+        session = await self._sessions.fetch_by_id(redis_conn, sid)
+        if session is None:
+            # Session was logged out
+            return
+        if time.time() - session.active_at > self.idle_timeout:
+            # Abandoned sessions are not kept alive at the IdP
+            self.idle += 1
+            return
+
+        await self.limiter.acquire()
+        response = await refresh(redis_conn, session.refresh_token)
+        access_token, refresh_token, expires_in = (
+            response['access_token'], response['refresh_token'],
+            response.get('expires_in'))
+
+        transaction = redis_conn.multi_exec()
+        new_sid = self._sessions.rotate(transaction, sid, session,
+                                        access_token, refresh_token,
+                                        expires_in)
+        client_sid, client_digest = session.client(sid)
+        rotated = {
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_at': time.time() + expires_in if expires_in else 0,
+            'client_digest': client_digest,
+        }
+        # Lives as long as the session the client holds tokens of, but
+        # token pairs of abandoned sessions do not stay forever
+        ttl = self._sessions.ttl
+        transaction.set(self.rotated_key(client_sid), json.dumps(rotated),
+                        expire=min(ttl, self.rotated_ttl) if ttl
+                        else self.rotated_ttl)
+        self.schedule(transaction, new_sid, expires_in)
+        await transaction.execute()
+        self.refreshed += 1
+
+
+_scheduler: Optional[RefreshScheduler] = None
+
+
+def get_refresh_scheduler() -> Optional[RefreshScheduler]:
+    return _scheduler
+
+
+def setup_refresh_scheduler(app: web.Application,
+                            **kwargs) -> RefreshScheduler:
+    from .utils import request_coalesced_refresh, session_store
+
+    global _scheduler
+
+    scheduler = _scheduler = RefreshScheduler(**kwargs)
+    app['refresh_scheduler'] = scheduler
+
+    async def start_refresh_scheduler(app):
+        scheduler.start(app['redis'], request_coalesced_refresh,
+                        session_store)
+
+    async def stop_refresh_scheduler(app):
+        await scheduler.stop()
+
+    app.on_startup.append(start_refresh_scheduler)
+    app.on_cleanup.append(stop_refresh_scheduler)
+    return scheduler
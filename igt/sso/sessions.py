@@ -0,0 +1,345 @@
+import base64
+import hashlib
+import json
+import os
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import NamedTuple, Optional, Tuple, Union
+
+import aioredis
+import jwt
+from aiohttp import web
+
+from . import avanpost
+from .cache import token_digest
+from .scheduler import get_refresh_scheduler
+
+_RAW, _ZLIB = b'r', b'z'
+
+
+class SessionRecord(NamedTuple):
+    refresh_token: str
+    expires_at: float
+    user_id: Optional[str] = None
+    # Last save on behalf of the client, proactive refreshes keep it
+    active_at: float = 0
+    # Session the client still holds tokens of, set by proactive refresh
+    client_sid: Optional[str] = None
+    client_digest: Optional[str] = None
+
+    @property
+    def expired(self) -> bool:
+        return bool(self.expires_at) and self.expires_at <= time.time()
+
+    def client(self, sid: str) -> Tuple[str, str]:
+        """
+        Session ID and refresh token digest the client holds tokens of
+        """
+        if self.client_sid is not None:
+            return self.client_sid, self.client_digest
+        return sid, token_digest(self.refresh_token).hex()
+
+
+def session_id(access_token: Union[str, bytes]) -> str:
+    """
+    Short session identifier: 128 bits of SHA-256 of the access token
+    """
+    if isinstance(access_token, str):
+        access_token = access_token.encode('utf-8')
+    digest = hashlib.sha256(access_token).digest()[:16]
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def get_user_id(access_token: Union[str, bytes]) -> Optional[str]:
+    try:
+        claims = jwt.decode(access_token,
+                            options={'verify_signature': False})
+    except jwt.DecodeError:
+        return None
+    return claims.get('sub')
+
+
+class SessionStore(ABC):
+    """
+    Backend keeping the refresh token and session metadata between
+    ``sso_callback``, ``refresh_tokens`` and ``logout``
+    """
+
+    @abstractmethod
+    async def save(self, request: web.Request, response: web.StreamResponse,
+                   access_token: Union[str, bytes], refresh_token: str,
+                   expires_in=0,
+                   previous_access_token: Union[str, bytes] = None,
+                   ) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def load(self, request: web.Request,
+                   access_token: Union[str, bytes]
+                   ) -> Optional[SessionRecord]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, request: web.Request,
+                     response: web.StreamResponse,
+                     access_token: Union[str, bytes]) -> None:
+        raise NotImplementedError
+
+
+class RedisSessionStore(SessionStore):
+    """
+    One Redis hash per session keyed by a short access token digest.
+
+    The hash holds the refresh token, access token expiry and user ID,
+    every operation is a single round trip. Refresh tokens longer than
+    ``compress_min_size`` are zlib-compressed when ``compress`` is set.
+    """
+    COMPRESS_MIN_SIZE = 256
+
+    def __init__(self,
+                 ttl: Optional[int] = None,
+                 compress: Optional[bool] = None,
+                 compress_min_size: int = COMPRESS_MIN_SIZE,
+                 ):
+        self._ttl = ttl
+        self._compress = compress
+        self.compress_min_size = compress_min_size
+
+    @property
+    def ttl(self) -> int:
+        return avanpost.SESSION_TTL if self._ttl is None else self._ttl
+
+    @property
+    def compress(self) -> bool:
+        if self._compress is None:
+            return avanpost.SESSION_COMPRESSION
+        return self._compress
+
+    @staticmethod
+    def key(sid: str) -> str:
+        return avanpost.SESSION_REDIS_KEY.format(session_id=sid)
+
+    def _pack(self, refresh_token: str) -> bytes:
+        value = refresh_token.encode('utf-8')
+        if self.compress and len(value) >= self.compress_min_size:
+            return _ZLIB + zlib.compress(value)
+        return _RAW + value
+
+    @staticmethod
+    def _unpack(value: bytes) -> str:
+        if value[:1] == _ZLIB:
+            return zlib.decompress(value[1:]).decode('utf-8')
+        return value[1:].decode('utf-8')
+
+    @classmethod
+    def _record(cls, fields: dict) -> Optional[SessionRecord]:
+        if not fields:
+            return None
+
+        def text(name: bytes) -> Optional[str]:
+            value = fields.get(name)
+            return value.decode('utf-8') if value else None
+
+        return SessionRecord(
+            refresh_token=cls._unpack(fields[b'refresh_token']),
+            expires_at=float(fields.get(b'expires_at', 0)),
+            user_id=text(b'user_id'),
+            active_at=float(fields.get(b'active_at', 0)),
+            client_sid=text(b'client_sid'),
+            client_digest=text(b'client_digest'),
+        )
+
+    def write(self, transaction, access_token: Union[str, bytes],
+              refresh_token: str, expires_in=0,
+              user_id: Optional[str] = None,
+              active_at: Optional[float] = None,
+              client_sid: Optional[str] = None,
+              client_digest: Optional[str] = None,
+              ) -> str:
+        """
+        Queue session write into a MULTI/EXEC, return session ID
+        """
+        sid = session_id(access_token)
+        key = self.key(sid)
+        now = time.time()
+        fields = {
+            'refresh_token': self._pack(refresh_token),
+            'expires_at': now + expires_in if expires_in else 0,
+            'active_at': now if active_at is None else active_at,
+        }
+        if user_id is not None:
+            fields['user_id'] = user_id
+        if client_sid is not None:
+            fields['client_sid'] = client_sid
+            fields['client_digest'] = client_digest
+        transaction.delete(key)
+        transaction.hmset_dict(key, fields)
+        ttl = self.ttl
+        if ttl:
+            transaction.expire(key, ttl)
+        return sid
+
+    async def store(self, redis_conn: aioredis.Redis,
+                    access_token: Union[str, bytes], refresh_token: str,
+                    expires_in=0,
+                    previous_access_token: Union[str, bytes] = None,
+                    ) -> str:
+        """
+        Write session, drop the replaced one and schedule proactive
+        refresh in a single MULTI/EXEC
+        """
+        transaction = redis_conn.multi_exec()
+        if previous_access_token is not None:
+            transaction.delete(self.key(session_id(previous_access_token)))
+        sid = self.write(transaction, access_token, refresh_token,
+                         expires_in, get_user_id(access_token))
+        scheduler = get_refresh_scheduler()
+        if scheduler is not None:
+            scheduler.schedule(transaction, sid, expires_in)
+        await transaction.execute()
+        return sid
+
+    def rotate(self, transaction, sid: str, session: SessionRecord,
+               access_token: Union[str, bytes], refresh_token: str,
+               expires_in=0) -> str:
+        """
+        Queue replacement of session ``sid`` by a proactively refreshed
+        pair into a MULTI/EXEC, return the new session ID.
+
+        The new session remembers the session and refresh token the
+        client holds, as well as its last activity.
+        """
+        transaction.delete(self.key(sid))
+        client_sid, client_digest = session.client(sid)
+        return self.write(transaction, access_token, refresh_token,
+                          expires_in, get_user_id(access_token),
+                          active_at=session.active_at,
+                          client_sid=client_sid,
+                          client_digest=client_digest)
+
+    async def fetch(self, redis_conn: aioredis.Redis,
+                    access_token: Union[str, bytes]
+                    ) -> Optional[SessionRecord]:
+        return await self.fetch_by_id(redis_conn, session_id(access_token))
+
+    async def fetch_by_id(self, redis_conn: aioredis.Redis,
+                          sid: str) -> Optional[SessionRecord]:
+        return self._record(await redis_conn.hgetall(self.key(sid)))
+
+    async def remove(self, redis_conn: aioredis.Redis,
+                     access_token: Union[str, bytes]) -> bool:
+        return bool(await redis_conn.delete(self.key(
+            session_id(access_token))))
+
+    async def save(self, request, response, access_token, refresh_token,
+                   expires_in=0, previous_access_token=None) -> None:
+        await self.store(request.app['redis'], access_token, refresh_token,
+                         expires_in, previous_access_token)
+
+    async def load(self, request, access_token) -> Optional[SessionRecord]:
+        return await self.fetch(request.app['redis'], access_token)
+
+    async def delete(self, request, response, access_token) -> None:
+        await self.remove(request.app['redis'], access_token)
+
+
+class CookieSessionStore(SessionStore):
+    """
+    Stateless sessions in an AES-GCM encrypted, authenticated cookie.
+
+    The cookie is bound to the access token by session ID. Redis only
+    keeps a small set of logged-out session IDs, so logged-out cookies
+    cannot be replayed.
+
+    Requires ``cryptography``.
+    """
+    COOKIE_NAME = 'sso_session'
+    REVOKED_REDIS_KEY = 'forest:sso:session:revoked:{session_id}'
+    DEFAULT_MAX_AGE = 30 * 24 * 3600
+    NONCE_SIZE = 12
+
+    def __init__(self,
+                 key: bytes,
+                 cookie_name: str = COOKIE_NAME,
+                 max_age: Optional[int] = None,
+                 secure: bool = True,
+                 samesite: str = 'Lax',
+                 ):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        if len(key) not in (16, 24, 32):
+            raise ValueError('key should be 16, 24 or 32 bytes long')
+        self._aead = AESGCM(key)
+        self._invalid_tag = InvalidTag
+        self.cookie_name = cookie_name
+        self._max_age = max_age
+        self.secure = secure
+        self.samesite = samesite
+
+    @property
+    def max_age(self) -> int:
+        if self._max_age is None:
+            return avanpost.SESSION_TTL or self.DEFAULT_MAX_AGE
+        return self._max_age
+
+    def _encrypt(self, record: dict) -> str:
+        nonce = os.urandom(self.NONCE_SIZE)
+        plaintext = zlib.compress(json.dumps(record).encode('utf-8'))
+        sealed = self._aead.encrypt(nonce, plaintext,
+                                    self.cookie_name.encode('utf-8'))
+        return base64.urlsafe_b64encode(nonce + sealed).decode('ascii')
+
+    def _decrypt(self, value: str) -> Optional[dict]:
+        try:
+            sealed = base64.urlsafe_b64decode(value.encode('ascii'))
+            plaintext = self._aead.decrypt(sealed[:self.NONCE_SIZE],
+                                           sealed[self.NONCE_SIZE:],
+                                           self.cookie_name.encode('utf-8'))
+            return json.loads(zlib.decompress(plaintext))
+        except (ValueError, self._invalid_tag, zlib.error):
+            return None
+
+    def _revoked_key(self, sid: str) -> str:
+        return self.REVOKED_REDIS_KEY.format(session_id=sid)
+
+    async def save(self, request, response, access_token, refresh_token,
+                   expires_in=0, previous_access_token=None) -> None:
+        value = self._encrypt({
+            'sid': session_id(access_token),
+            'refresh_token': refresh_token,
+            'expires_at': time.time() + expires_in if expires_in else 0,
+            'user_id': get_user_id(access_token),
+        })
+        response.set_cookie(self.cookie_name, value,
+                            max_age=self.max_age,
+                            httponly=True,
+                            secure=self.secure,
+                            samesite=self.samesite)
+
+    async def load(self, request, access_token) -> Optional[SessionRecord]:
+        value = request.cookies.get(self.cookie_name)
+        record = self._decrypt(value) if value else None
+        if record is None:
+            return None
+        sid = session_id(access_token)
+        if record['sid'] != sid:
+            return None
+        if await request.app['redis'].exists(self._revoked_key(sid)):
+            return None
+        return SessionRecord(record['refresh_token'],
+                             record['expires_at'],
+                             record['user_id'])
+
+    async def delete(self, request, response, access_token) -> None:
+        await request.app['redis'].set(
+            self._revoked_key(session_id(access_token)), '1',
+            expire=self.max_age)
+        response.del_cookie(self.cookie_name)
+
+
+def setup_session_store(app: web.Application,
+                        store: SessionStore) -> SessionStore:
+    app['session_store'] = store
+    return store
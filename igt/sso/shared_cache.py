@@ -0,0 +1,331 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from typing import Dict, Optional, Tuple, Union
+
+from aiohttp import web
+
+from .cache import CachedToken, VerifiedTokenCache, token_digest
+
+_MAGIC = b'IGTSSO02'
+# magic, slot count, slot size
+_FILE_HEADER = struct.Struct('<8sII')
+# crc32, expires_at, max_age, document length
+_JWKS_HEADER = struct.Struct('<IddI')
+# crc32, digest, expires_at, groups mask, flags, payload length
+_SLOT_HEADER = struct.Struct('<I32sdQII')
+
+_OCCUPIED, _HAS_MASK, _REVOKED = 1, 2, 4
+_MAX_MASK = 2 ** 64
+
+
+def _check_private(fd: int, path: str) -> None:
+    # Entries are trusted as verified tokens, nobody else may write them
+    stat = os.fstat(fd)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise PermissionError(
+            f'{path} should be owned by uid {os.getuid()} '
+            f'and not accessible to others')
+
+
+def _private_directory(path: str) -> str:
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        _check_private(fd, path)
+    finally:
+        os.close(fd)
+    return path
+
+
+class SharedMemoryTable:
+    """
+    Host-local table of verified tokens in a memory-mapped file.
+
+    All workers on the host map the same file. Each slot carries a
+    CRC32 of its contents, so readers need no lock: a slot torn by a
+    concurrent writer fails the checksum and reads as a miss. A token
+    is looked up in ``PROBES`` consecutive slots from its digest
+    position, writers replace the entry expiring first. The file also
+    holds the latest JWKS document for ``JWKSStore``.
+
+    Entries are trusted as verified, so the file is created in one
+    step, readable and writable by the service user only, in a private
+    directory by default. A file owned by someone else, accessible to
+    others or laid out for other ``slots`` and ``slot_size`` is
+    refused: every worker on the host should open the table with the
+    same settings.
+    """
+    SHM_DIRECTORY = ('/dev/shm' if os.path.isdir('/dev/shm')
+                     else tempfile.gettempdir())
+    FILE_NAME = 'igt-sso-cache'
+    DEFAULT_SLOTS = 16_384
+    DEFAULT_SLOT_SIZE = 2048
+    JWKS_SIZE = 64 * 1024
+    PROBES = 4
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 slots: int = DEFAULT_SLOTS,
+                 slot_size: int = DEFAULT_SLOT_SIZE,
+                 ):
+        if slot_size <= _SLOT_HEADER.size:
+            raise ValueError(
+                f'slot_size should be larger than {_SLOT_HEADER.size}')
+        if path is None:
+            path = os.path.join(
+                _private_directory(os.path.join(
+                    self.SHM_DIRECTORY, f'igt-sso-{os.getuid()}')),
+                self.FILE_NAME)
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self._jwks_offset = _FILE_HEADER.size
+        self._slots_offset = self._jwks_offset + self.JWKS_SIZE
+        self.size = self._slots_offset + slots * slot_size
+
+        self._map = self._create() or self._open()
+
+    def _create(self) -> Optional[mmap.mmap]:
+        """
+        Lay out a new table and publish it atomically, unless another
+        worker did first
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                        prefix='.igt-sso-')
+        try:
+            os.ftruncate(fd, self.size)
+            table = mmap.mmap(fd, self.size)
+            _FILE_HEADER.pack_into(table, 0, _MAGIC, self.slots,
+                                   self.slot_size)
+            try:
+                os.link(tmp_path, self.path)
+            except FileExistsError:
+                table.close()
+                return None
+            return table
+        finally:
+            os.close(fd)
+            os.unlink(tmp_path)
+
+    def _open(self) -> mmap.mmap:
+        fd = os.open(self.path, os.O_RDWR | os.O_NOFOLLOW)
+        try:
+            _check_private(fd, self.path)
+            # Resizing would fault the other workers' mappings
+            if os.fstat(fd).st_size != self.size:
+                raise RuntimeError(
+                    f'{self.path} has a different size, check slots and '
+                    f'slot_size of all workers or remove the file')
+            table = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        if _FILE_HEADER.unpack_from(table, 0) != (_MAGIC, self.slots,
+                                                  self.slot_size):
+            table.close()
+            raise RuntimeError(
+                f'{self.path} has a different layout, check slots and '
+                f'slot_size of all workers or remove the file')
+        return table
+
+    @property
+    def payload_capacity(self) -> int:
+        return self.slot_size - _SLOT_HEADER.size
+
+    def close(self) -> None:
+        self._map.close()
+
+    def _offsets(self, digest: bytes):
+        start = int.from_bytes(digest[:8], 'little') % self.slots
+        for probe in range(self.PROBES):
+            yield (self._slots_offset
+                   + (start + probe) % self.slots * self.slot_size)
+
+    def _read(self, offset: int) -> Optional[Tuple[bytes, float, int,
+                                                   int, bytes]]:
+        slot = self._map[offset:offset + self.slot_size]
+        crc, digest, expires_at, mask, flags, length = (
+            _SLOT_HEADER.unpack_from(slot))
+        if not flags & _OCCUPIED or length > self.payload_capacity:
+            return None
+        end = _SLOT_HEADER.size + length
+        if zlib.crc32(slot[4:end]) != crc:
+            return None
+        return digest, expires_at, mask, flags, slot[_SLOT_HEADER.size:end]
+
+    def _write(self, offset: int, digest: bytes, expires_at: float,
+               mask: int, flags: int, data: bytes) -> None:
+        slot = bytearray(_SLOT_HEADER.size + len(data))
+        _SLOT_HEADER.pack_into(slot, 0, 0, digest, expires_at, mask,
+                               flags | _OCCUPIED, len(data))
+        slot[_SLOT_HEADER.size:] = data
+        struct.pack_into('<I', slot, 0, zlib.crc32(memoryview(slot)[4:]))
+        self._map[offset:offset + len(slot)] = slot
+
+    def lookup(self, digest: bytes):
+        """
+        Return ``(expires_at, mask, flags, data)`` of a live entry
+        """
+        now = time.time()
+        for offset in self._offsets(digest):
+            entry = self._read(offset)
+            if entry is not None and entry[0] == digest:
+                if entry[1] <= now:
+                    return None
+                return entry[1:]
+        return None
+
+    def store(self, digest: bytes, expires_at: float, mask: int,
+              flags: int, data: bytes = b'') -> bool:
+        if len(data) > self.payload_capacity:
+            return False
+        target, target_expires_at = None, float('inf')
+        for offset in self._offsets(digest):
+            entry = self._read(offset)
+            if entry is None or entry[0] == digest:
+                target = offset
+                break
+            if entry[1] < target_expires_at:
+                target, target_expires_at = offset, entry[1]
+        self._write(target, digest, expires_at, mask, flags, data)
+        return True
+
+    def get_jwks(self) -> Optional[Tuple[Dict, float, float]]:
+        """
+        Return the shared JWKS document with its remaining and full lifetime
+        """
+        start = self._jwks_offset + _JWKS_HEADER.size
+        crc, expires_at, lifetime, length = _JWKS_HEADER.unpack_from(
+            self._map, self._jwks_offset)
+        if not length or length > self.JWKS_SIZE - _JWKS_HEADER.size:
+            return None
+        document = self._map[start:start + length]
+        if zlib.crc32(document) != crc:
+            return None
+        max_age = expires_at - time.time()
+        if max_age <= 0:
+            return None
+        return json.loads(document), max_age, lifetime
+
+    def set_jwks(self, jwks: Dict, max_age: float) -> None:
+        document = json.dumps(jwks, separators=(',', ':')).encode('utf-8')
+        if len(document) > self.JWKS_SIZE - _JWKS_HEADER.size:
+            return
+        start = self._jwks_offset + _JWKS_HEADER.size
+        self._map[start:start + len(document)] = document
+        _JWKS_HEADER.pack_into(self._map, self._jwks_offset,
+                               zlib.crc32(document),
+                               time.time() + max_age, max_age,
+                               len(document))
+
+
+class SharedTokenCache(VerifiedTokenCache):
+    """
+    Per-worker LRU in front of a ``SharedMemoryTable``.
+
+    A token verified by any worker on the host is a cache hit for all
+    of them. Invalidation leaves a revoked marker in the shared table,
+    so other workers stop serving the token and answer the revocation
+    check without Redis.
+    """
+    REVOKED_TTL = 3600
+
+    def __init__(self,
+                 table: SharedMemoryTable,
+                 maxsize: int = VerifiedTokenCache.DEFAULT_MAXSIZE,
+                 max_ttl: Optional[float] = None,
+                 ):
+        super().__init__(maxsize, max_ttl)
+        self.table = table
+        self.shared_hits = 0
+
+    def get(self, token: Union[str, bytes]) -> Optional[CachedToken]:
+        entry = super().get(token)
+        if entry is not None:
+            return entry
+
+        digest = token_digest(token)
+        shared = self.table.lookup(digest)
+        if shared is None:
+            return None
+        expires_at, mask, flags, data = shared
+        if flags & _REVOKED:
+            return None
+        payload = json.loads(data)
+        groups_mask = mask if flags & _HAS_MASK else None
+        super().set(token, payload, groups_mask)
+        self.shared_hits += 1
+        # Counted as a miss by the local lookup above
+        self.misses -= 1
+        self.hits += 1
+        return self._entries[digest]
+
+    def set(self, token: Union[str, bytes], payload: dict,
+            groups_mask: int) -> None:
+        super().set(token, payload, groups_mask)
+        expires_at = payload.get('exp')
+        if expires_at is None:
+            return
+        if self.max_ttl is not None:
+            expires_at = min(expires_at, time.time() + self.max_ttl)
+
+        digest = token_digest(token)
+        shared = self.table.lookup(digest)
+        if shared is not None and shared[2] & _REVOKED:
+            return
+        flags = 0
+        mask = 0
+        if groups_mask is not None and 0 <= groups_mask < _MAX_MASK:
+            flags, mask = _HAS_MASK, groups_mask
+        self.table.store(digest, expires_at, mask, flags,
+                         json.dumps(payload,
+                                    separators=(',', ':')).encode('utf-8'))
+
+    def invalidate(self, token: Union[str, bytes]) -> None:
+        super().invalidate(token)
+        digest = token_digest(token)
+        shared = self.table.lookup(digest)
+        expires_at = (shared[0] if shared is not None
+                      else time.time() + self.REVOKED_TTL)
+        self.table.store(digest, expires_at, 0, _REVOKED)
+
+    def is_revoked(self, token: Union[str, bytes]) -> bool:
+        shared = self.table.lookup(token_digest(token))
+        return shared is not None and bool(shared[2] & _REVOKED)
+
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        stats = super().stats
+        stats['shared_hits'] = self.shared_hits
+        return stats
+
+
+def setup_shared_cache(app: web.Application,
+                       maxsize: int = VerifiedTokenCache.DEFAULT_MAXSIZE,
+                       max_ttl: Optional[float] = None,
+                       **kwargs) -> SharedTokenCache:
+    """
+    Map the host-wide table and share JWKS downloads between workers.
+
+    Pass the returned cache to ``AvanpostJWTMiddleware(token_cache=...)``.
+    """
+    from .utils import jwks_store
+
+    table = SharedMemoryTable(**kwargs)
+    cache = SharedTokenCache(table, maxsize, max_ttl)
+    jwks_store.shared = table
+    app['shared_cache'] = cache
+
+    async def close_shared_cache(app):
+        jwks_store.shared = None
+        table.close()
+
+    app.on_cleanup.append(close_shared_cache)
+    return cache
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import secrets
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Union
+
+import aioredis
+
+from .cache import token_digest
+
+# Delete the lock only if it is still held by the caller
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+
+class RefreshFailedError(RuntimeError):
+    pass
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls sharing a key into one execution.
+
+    The first caller runs the coroutine, callers arriving while it is in
+    flight await the same result or exception.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        total = self.calls + self.coalesced
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._calls),
+            'coalescing_rate': self.coalesced / total if total else 0.0,
+        }
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        self.calls += 1
+        try:
+            result = await func()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+class RefreshCoalescer(SingleFlight):
+    """
+    Single-flight token refresh within a process and across workers.
+
+    Across workers a short Redis lock elects one refresher, the others
+    poll for the result it publishes for ``result_ttl`` seconds, or for
+    its failure, published for ``error_ttl`` seconds. A refresh token
+    is never sent to the IdP twice while its lock is held: followers
+    take over only once the lock is released or has expired.
+
+    ``lock_ttl`` should exceed the IdP timeout of the circuit breaker.
+    """
+    LOCK_REDIS_KEY = 'forest:sso:refresh:lock:{digest}'
+    RESULT_REDIS_KEY = 'forest:sso:refresh:result:{digest}'
+    LOCK_TTL = 15
+    RESULT_TTL = 10
+    ERROR_TTL = 1
+    POLL_INTERVAL = 0.05
+
+    def __init__(self,
+                 lock_ttl: float = LOCK_TTL,
+                 result_ttl: int = RESULT_TTL,
+                 error_ttl: float = ERROR_TTL,
+                 poll_interval: float = POLL_INTERVAL,
+                 ):
+        super().__init__()
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.error_ttl = error_ttl
+        self.poll_interval = poll_interval
+        self.remote_coalesced = 0
+
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        stats = super().stats
+        stats['remote_coalesced'] = self.remote_coalesced
+        return stats
+
+    async def refresh(self,
+                      redis_conn: aioredis.Redis,
+                      refresh_token: Union[str, bytes],
+                      func: Callable[[], Awaitable[Dict]],
+                      ) -> Dict:
+        digest = token_digest(refresh_token).hex()
+        return await self.do(
+            digest, lambda: self._refresh_locked(redis_conn, digest, func))
+
+    async def _refresh_locked(self, redis_conn, digest, func) -> Dict:
+        lock_key = self.LOCK_REDIS_KEY.format(digest=digest)
+        result_key = self.RESULT_REDIS_KEY.format(digest=digest)
+        owner = secrets.token_hex(16)
+
+        deadline = time.monotonic() + self.lock_ttl
+        while True:
+            # Refresh token was already rotated by another worker
+            published = await self._published(redis_conn, result_key)
+            if published is not None:
+                return published
+
+            if await redis_conn.set(lock_key, owner,
+                                    pexpire=int(self.lock_ttl * 1000),
+                                    exist=redis_conn.SET_IF_NOT_EXIST):
+                break
+            if time.monotonic() >= deadline:
+                raise RefreshFailedError(
+                    'Timed out waiting for another worker to refresh')
+            await asyncio.sleep(self.poll_interval)
+
+        # The previous holder may have published and released the lock
+        # between our GET and SET NX
+        try:
+            published = await self._published(redis_conn, result_key)
+        except BaseException:
+            await self._release(redis_conn, lock_key, owner)
+            raise
+        if published is not None:
+            await self._release(redis_conn, lock_key, owner)
+            return published
+
+        try:
+            result = await func()
+        except Exception as e:
+            # Followers fail fast instead of polling until the deadline,
+            # a published result is never replaced by an error
+            await redis_conn.set(result_key,
+                                 json.dumps({'error': str(e)}),
+                                 pexpire=int(self.error_ttl * 1000),
+                                 exist=redis_conn.SET_IF_NOT_EXIST)
+            raise
+        else:
+            await redis_conn.set(result_key,
+                                 json.dumps({'result': result}),
+                                 expire=self.result_ttl)
+            return result
+        finally:
+            await self._release(redis_conn, lock_key, owner)
+
+    async def _published(self, redis_conn, result_key) -> Optional[Dict]:
+        published = await redis_conn.get(result_key, encoding='utf-8')
+        if published is None:
+            return None
+        self.remote_coalesced += 1
+        published = json.loads(published)
+        if 'error' in published:
+            raise RefreshFailedError(published['error'])
+        return published['result']
+
+    @staticmethod
+    async def _release(redis_conn, lock_key, owner) -> None:
+        await redis_conn.eval(RELEASE_LOCK_SCRIPT,
+                              keys=[lock_key], args=[owner])
@@ -1,19 +1,39 @@
+import asyncio
 import base64
 import hashlib
+import hmac
 import http
 import json
 import os
 import re
-from typing import Union, Dict
+import time
+from typing import Union, Dict, Optional, Tuple
 
 import aiohttp
 import aioredis
 import jwt.algorithms
-import requests
 from aiohttp import web
 from aiohttp.web_request import Request
-import gateway_logger
-from . import avanpost
+from . import avanpost, log
+from .batcher import verify_signature
+from .breaker import CircuitOpenError, get_circuit_breaker, guarded
+from .cache import token_digest
+from .client import get_idp_client
+from .instrumentation import get_instrumentation, timed
+from .jwks import JWKSStore, SigningKey
+from .pkce import PKCEStateStore
+from .revocation import revoke_token, revoked_key
+from .scheduler import RefreshScheduler, get_refresh_scheduler
+from .sessions import (RedisSessionStore,
+                       SessionRecord,
+                       SessionStore,
+                       session_id)
+from .singleflight import RefreshCoalescer
+
+jwks_store = JWKSStore()
+refresh_coalescer = RefreshCoalescer()
+pkce_store = PKCEStateStore()
+session_store = RedisSessionStore()
 
 
 async def get_code_verifier() -> str:
@@ -32,73 +52,141 @@ async def get_code_challenge(code_verifier: str) -> str:
 
 async def set_code_verifier(code_verifier: str,
                             redis_conn: aioredis.Redis,
-                            state: str
+                            state: str,
+                            client: Optional[str] = None,
                             ) -> None:
-    code_verifier_key = avanpost.CODE_VERIFIER_REDIS_KEY.format(state=state)
-    await redis_conn.set(key=code_verifier_key, value=code_verifier)
-    assert await redis_conn.exists(code_verifier_key)
+    await pkce_store.save(redis_conn, state, code_verifier, client)
 
 
-async def revoke_code_verifier(redis_conn: aioredis.Redis, state):
-    code_verifier_key = avanpost.CODE_VERIFIER_REDIS_KEY.format(state=state)
-    await redis_conn.delete(code_verifier_key)
-    assert not await redis_conn.exists(code_verifier_key)
-
+async def pop_code_verifier(redis_conn: aioredis.Redis,
+                            state: str,
+                            client: Optional[str] = None,
+                            ) -> Optional[str]:
+    """
+    Read and delete code verifier atomically (GETDEL) in one round trip
+    """
+    return await pkce_store.pop(redis_conn, state, client)
 
-async def has_permissions(token: dict):
-    return any(group.get('name') == avanpost.PARMA_ML_GROUP_NAME
-               for group in token.get('groups'))
 
+async def set_tokens(redis_conn: aioredis.Redis,
+                     access_token: Union[str, bytes],
+                     refresh_token: Union[str, bytes],
+                     expires_in=0,
+                     previous_access_token: Union[str, bytes] = None,
+                     ) -> None:
+    """
+    Store the session record in Redis in a single round trip,
+    replacing the session of ``previous_access_token`` if given
+    """
+    log.debug('set tokens', access_token=access_token,
+              refresh_token=refresh_token, expires_in=expires_in)
+    await session_store.store(redis_conn, access_token, refresh_token,
+                              expires_in, previous_access_token)
 
-async def set_access_token(redis_conn: aioredis.Redis,
-                           access_token: Union[str, bytes],
-                           expires_in=0
-                           ) -> None:
-    gateway_logger.debug(f"Setting access token: {access_token=:.50}")
-    await redis_conn.set(key=avanpost.TOKEN_REDIS_KEY,
-                         value=access_token,
-                         expire=expires_in)
 
+def get_session_store(app: web.Application) -> SessionStore:
+    return app.get('session_store', session_store)
 
-async def set_refresh_token(redis_conn, access_token, refresh_token):
-    gateway_logger.debug(f"Setting refresh token: {refresh_token=:.50}")
-    access_token_key = f"{avanpost.TOKEN_REDIS_KEY}:{access_token}"
-    await redis_conn.set(key=access_token_key, value=refresh_token)
 
+async def pop_rotated_tokens(redis_conn: aioredis.Redis,
+                             access_token: Union[str, bytes],
+                             refresh_token: Union[str, bytes],
+                             ) -> Optional[Dict]:
+    """
+    Return tokens already rotated by the refresh scheduler, if any.
 
-async def get_public_key(token: Union[str, bytes]):
-    # for JWKS that contain multiple JWK
-    response = requests.get(avanpost.PUBLIC_KEY_URL)
+    Only the holder of the refresh token they replace gets them.
+    """
+    rotated = await get_rotated_tokens(redis_conn, access_token)
+    if rotated is None:
+        return None
+    client_digest = rotated.pop('client_digest')
+    if refresh_token is None or not hmac.compare_digest(
+            client_digest, token_digest(refresh_token).hex()):
+        return None
+    await redis_conn.delete(
+        RefreshScheduler.rotated_key(session_id(access_token)))
+    expires_at = rotated.pop('expires_at')
+    # Lifetime left at pickup, an expired pair is refreshed right away
+    rotated['expires_in'] = (max(1, int(expires_at - time.time()))
+                             if expires_at else None)
+    return rotated
+
+
+async def get_rotated_tokens(redis_conn: aioredis.Redis,
+                             access_token: Union[str, bytes]
+                             ) -> Optional[Dict]:
+    """
+    Tokens the refresh scheduler rotated the session of ``access_token``
+    to, without handing them out
+    """
+    rotated = await redis_conn.get(
+        RefreshScheduler.rotated_key(session_id(access_token)),
+        encoding='utf-8')
+    return json.loads(rotated) if rotated is not None else None
 
-    gateway_logger.debug(f"Requesting public keys. "
-                         f"URL: {response.request.url}"
-                         f"Headers: {response.request.headers}"
-                         f"Body: {response.request.body}")
-    assert response.status_code == http.HTTPStatus.OK, response.reason
 
-    public_keys = {}
+async def resolve_session(request: Request,
+                          access_token: Union[str, bytes],
+                          ) -> Tuple[Optional[SessionRecord],
+                                     Optional[Dict]]:
+    """
+    Session of ``access_token`` or, once the refresh scheduler rotated
+    it, the session that replaced it along with the rotated tokens
+    """
+    store = get_session_store(request.app)
+    session = await store.load(request, access_token)
+    if session is not None or get_refresh_scheduler() is None:
+        return session, None
+    rotated = await get_rotated_tokens(request.app['redis'], access_token)
+    if rotated is None:
+        return None, None
+    return await store.load(request, rotated['access_token']), rotated
+
+
+async def discard_rotated_tokens(request: Request,
+                                 response: web.StreamResponse,
+                                 access_token: Union[str, bytes],
+                                 rotated: Dict) -> None:
+    """
+    Delete and revoke the session the refresh scheduler rotated the
+    session of ``access_token`` to
+    """
+    redis_conn = request.app['redis']
+    await get_session_store(request.app).delete(request, response,
+                                                rotated['access_token'])
+    await redis_conn.delete(
+        RefreshScheduler.rotated_key(session_id(access_token)))
+    await revoke_token(redis_conn, rotated['access_token'],
+                       rotated['expires_at'] or None)
 
-    for jwk in response.json()['keys']:
-        kid = jwk['kid']
-        public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(
-            json.dumps(jwk))
 
+async def get_public_key(token: Union[str, bytes]):
+    # for JWKS that contain multiple JWK
     if not token:
-        return public_keys['1']
+        return await jwks_store.get_key('1')
 
     kid = jwt.get_unverified_header(token)['kid']
-    return public_keys[kid]
+    return await jwks_store.get_key(kid)
 
 
-async def is_revoked(request: Request, token: bytes):
+async def is_revoked(request: Request, token: bytes) -> bool:
+    shared_cache = request.app.get('shared_cache')
+    if shared_cache is not None and shared_cache.is_revoked(token):
+        return True
     redis_conn = request.app['redis']
-    await redis_conn.exists(f"{avanpost.TOKEN_REDIS_KEY}:{token}")
+    revocation = request.app.get('revocation')
+    if revocation is not None:
+        return await revocation.is_revoked(redis_conn, token)
+    return bool(await redis_conn.exists(revoked_key(token_digest(token))))
 
 
 async def generate_state():
     return await get_code_verifier()
 
 
+@timed('idp.exchange')
+@guarded
 async def request_exchange(pkce_code: Union[str, bytes],
                            code_verifier: Union[str, bytes]
                            ) -> Dict:
@@ -106,37 +194,86 @@ async def request_exchange(pkce_code: Union[str, bytes],
     Промежуточный метод, позволяет не забивать голову форматами запроса
     и ответа.
     """
-    async with aiohttp.ClientSession() as session:
-        async with await session.post(url=avanpost.TOKEN_URL, json={
-            "grant_type": "authorization_code",
-            "client_id": avanpost.CLIENT_ID,
-            "redirect_uri": avanpost.AUTHORIZATION_REDIRECT_URL,
-            "code": str(pkce_code),
-            "code_verifier": str(code_verifier),
-        }) as response:
-            gateway_logger.debug(
-                f"Requested PKCE. "
-                f"Request URL: {response.request_info.url} \n"
-                f"Request Headers: {response.request_info.headers} \n"
-                f"Request Body: {response.request_info} \n"
-                f"PKCE Code: {pkce_code} \n"
-                f"Code verifier: {code_verifier}")
-            return await json_or_raise_for_status(response)
+    async with get_idp_client().post(url=avanpost.TOKEN_URL, json={
+        "grant_type": "authorization_code",
+        "client_id": avanpost.CLIENT_ID,
+        "redirect_uri": avanpost.AUTHORIZATION_REDIRECT_URL,
+        "code": str(pkce_code),
+        "code_verifier": str(code_verifier),
+    }) as response:
+        log.debug('idp exchange', url=response.request_info.url,
+                  headers=response.request_info.headers,
+                  status=response.status, code=pkce_code,
+                  code_verifier=code_verifier)
+        return await json_or_raise_for_status(response)
+
+
+@timed('idp.refresh')
+@guarded
+async def request_refresh(refresh_token) -> Dict:
+    async with get_idp_client().post(url=avanpost.TOKEN_URL, json={
+        "grant_type": "refresh_token",
+        "client_id": avanpost.CLIENT_ID,
+        "redirect_uri": avanpost.AUTHORIZATION_REDIRECT_URL,
+        "refresh_token": str(refresh_token)
+    }) as response:
+        log.debug('idp refresh', url=response.request_info.url,
+                  headers=response.request_info.headers,
+                  status=response.status)
+        return await json_or_raise_for_status(response)
+
+
+@timed('idp.revocation')
+async def request_revocation(token: Union[str, bytes],
+                             retries: int = avanpost.REVOCATION_RETRIES,
+                             timeout: float = avanpost.REVOCATION_TIMEOUT,
+                             backoff: float = 0.2,
+                             ) -> None:
+    """
+    Revoke token at the issuer, retrying on timeouts and 5xx responses
+    """
+    data = {
+        'client_id': avanpost.CLIENT_ID,
+        'client_secret': avanpost.CLIENT_SECRET,
+        'token': token,
+    }
+    breaker = get_circuit_breaker()
+    error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            status, error = await breaker.call(
+                lambda: post_revocation(data, timeout), timeout)
+            if status == http.HTTPStatus.OK:
+                return
+            break
+        except CircuitOpenError as e:
+            error = str(e)
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = repr(e)
+    raise ValueError(
+        f'Could not revoke token from issuer. Issuer response: {error}')
+
+
+async def post_revocation(data: Dict, timeout: float) -> Tuple[int, str]:
+    async with get_idp_client().post(avanpost.TOKEN_REVOCATION_URL,
+                                     data=data,
+                                     timeout=timeout) as response:
+        # 5xx is retried and counted by the circuit breaker
+        if response.status >= http.HTTPStatus.INTERNAL_SERVER_ERROR:
+            response.raise_for_status()
+        return response.status, await response.text()
 
 
-async def request_refresh(refresh_token) -> Dict:
-    async with aiohttp.ClientSession() as session:
-        async with await session.post(url=avanpost.TOKEN_URL, json={
-            "grant_type": "refresh_token",
-            "client_id": avanpost.CLIENT_ID,
-            "redirect_uri": avanpost.AUTHORIZATION_REDIRECT_URL,
-            "refresh_token": str(refresh_token)
-        }) as response:
-            gateway_logger.debug(f"Requested Access Token refresh. "
-                                 f"Request Headers: "
-                                 f"{response.request_info.headers} \n"
-                                 f"Request Body: {response.request_info}")
-            return await json_or_raise_for_status(response)
+async def request_coalesced_refresh(redis_conn: aioredis.Redis,
+                                    refresh_token) -> Dict:
+    """
+    Refresh once per refresh token, sharing the result with parallel callers
+    """
+    return await refresh_coalescer.refresh(
+        redis_conn, refresh_token, lambda: request_refresh(refresh_token))
 
 
 async def json_or_raise_for_status(response: aiohttp.ClientResponse) -> Dict:
@@ -144,7 +281,7 @@ async def json_or_raise_for_status(response: aiohttp.ClientResponse) -> Dict:
         response_dict = await response.json()
     except json.JSONDecodeError as e:
         raise web.HTTPBadRequest(reason=str(e))
-    gateway_logger.debug(f"Got response: {response_dict}")
+    log.debug('idp response', status=response.status, body=response_dict)
     if response_dict.get('access_token'):
         return response_dict
     if response_dict.get('error') is not None:
@@ -153,53 +290,107 @@ async def json_or_raise_for_status(response: aiohttp.ClientResponse) -> Dict:
     return response_dict
 
 
-async def request_json_web_keys(jwks_uri=avanpost.PUBLIC_KEY_URL):
-    async with aiohttp.ClientSession() as session:
-        async with await session.get(url=jwks_uri) as response:
-            response.raise_for_status()
-            return await response.json()
+@timed('idp.jwks')
+@guarded
+async def request_json_web_keys(jwks_uri=None):
+    jwks_uri = jwks_uri or avanpost.PUBLIC_KEY_URL
+    async with get_idp_client().get(url=jwks_uri) as response:
+        response.raise_for_status()
+        return await response.json()
 
 
-async def request_token_info(token, userinfo_url=avanpost.USERINFO_URL):
+@timed('idp.userinfo')
+@guarded
+async def request_token_info(token, userinfo_url=None):
+    userinfo_url = userinfo_url or avanpost.USERINFO_URL
     headers = {"Authorization": f"Bearer {token}"}
-    async with aiohttp.ClientSession() as session:
-        async with await session.get(
-                url=userinfo_url,
-                headers=headers
-        ) as response:
-            response.raise_for_status()
-            return await response.json()
+    async with get_idp_client().get(
+            url=userinfo_url,
+            headers=headers
+    ) as response:
+        response.raise_for_status()
+        return await response.json()
 
 
-async def decode_avanpost_jwt(token: str):
-    algorithms = [avanpost.DEFAULT_HASH_ALGORITHM]
-    info = await request_token_info(token)
-    public_key = await request_public_key(token)
+async def decode_avanpost_jwt(token: str, verify_locally=None):
+    """
+    Verify token signature and claims.
 
-    return jwt.decode(token,
-                      public_key,
-                      algorithms=algorithms,
-                      issuer=avanpost.ISSUER,
-                      audience=info['aud'])
+    In local mode signature, issuer, expiry and audience are checked
+    against configuration, userinfo is requested only for claims
+    missing from the token.
+    """
+    if verify_locally is None:
+        verify_locally = avanpost.LOCAL_VERIFICATION
+    instrumentation = get_instrumentation()
+
+    info = None
+    if not verify_locally:
+        try:
+            info = await request_token_info(token)
+        except CircuitOpenError:
+            # Issuer is down, verify locally against the cached keys
+            log.debug('userinfo unavailable, verifying locally')
+
+    with instrumentation.stage('jwks'):
+        signing_key = await request_signing_key(token)
+    # Algorithm comes from the key, never from the token header alone
+    algorithms = [signing_key.algorithm or avanpost.DEFAULT_HASH_ALGORITHM]
+
+    if info is not None:
+        with instrumentation.stage('signature'):
+            return await verify_signature(token,
+                                          signing_key.key,
+                                          algorithms=algorithms,
+                                          issuer=avanpost.ISSUER,
+                                          audience=info['aud'])
+
+    with instrumentation.stage('signature'):
+        payload = await verify_signature(token,
+                                         signing_key.key,
+                                         algorithms=algorithms,
+                                         issuer=avanpost.ISSUER,
+                                         options={'verify_aud': False,
+                                                  'require': ['exp', 'iss']})
+
+    missing_claims = [claim for claim in avanpost.USERINFO_CLAIMS
+                      if claim not in payload]
+    if missing_claims:
+        try:
+            info = await request_token_info(token)
+        except CircuitOpenError:
+            info = {}
+        for claim in missing_claims:
+            if claim in info:
+                payload[claim] = info[claim]
+
+    verify_audience(payload, avanpost.AUDIENCES)
+    return payload
+
+
+def verify_audience(payload: dict, audiences) -> None:
+    audience = payload.get('aud')
+    if audience is None:
+        raise jwt.MissingRequiredClaimError('aud')
+    if isinstance(audience, str):
+        audience = [audience]
+    if not any(aud in audiences for aud in audience):
+        raise jwt.InvalidAudienceError('Invalid audience')
 
 
 async def request_public_key(token):
-    jwks = await request_json_web_keys()
-    keys = {jwk['kid']: jwk for jwk in jwks['keys']}
+    return (await request_signing_key(token)).key
+
+
+async def request_signing_key(token) -> SigningKey:
     kid = jwt.get_unverified_header(token)['kid']
-    return jwt.algorithms.RSAAlgorithm.from_jwk(keys[kid])
+    return await jwks_store.get_signing_key(kid)
 
 
-async def has_token_expired(redis: aioredis.Redis,
-                            access_token_key: str
+async def has_token_expired(request: Request,
+                            access_token: Union[str, bytes]
                             ) -> bool:
-    ttl = await redis.ttl(access_token_key)
-    if ttl == -2:
-        # Key does not exist
-        raise KeyError(f"Key {access_token_key} does not exist")
-    elif ttl == -1:
-        # Key exists but never expires
-        return False
-    else:
-        # Check if the TTL is greater than 0
-        return ttl <= 0
+    session, _ = await resolve_session(request, access_token)
+    if session is None:
+        raise KeyError("Session does not exist")
+    return session.expired
@@ -1,43 +1,37 @@
-import http
 from typing import Dict
 
 import aiohttp
-import requests
 import shielded  # prevents POST controllers from cancellation
 from aiohttp import web
 
-from . import avanpost, utils
+from . import avanpost, log
 from .exceptions import TokenAlreadyRevoked
-from .logger import gateway_logger
-from .utils import (generate_state,
-                    get_code_verifier,
-                    set_code_verifier,
-                    get_code_challenge,
-                    revoke_code_verifier,
-                    set_access_token,
-                    set_refresh_token,
+from .instrumentation import timed
+from .pkce import bind_client, client_key, generate_pkce
+from .revocation import revoke_token
+from .scheduler import get_refresh_scheduler
+from .singleflight import RefreshFailedError
+from .utils import (set_code_verifier,
+                    pop_code_verifier,
+                    get_session_store,
+                    pop_rotated_tokens,
                     request_exchange,
-                    request_refresh, has_token_expired
+                    request_coalesced_refresh, has_token_expired,
+                    request_revocation,
+                    resolve_session,
+                    discard_rotated_tokens,
                     )
 
 
+@timed('view.login')
 async def login(request):
     """Issue code verifier & state for PKCE flow"""
-    state = await generate_state()
-    code_verifier = await get_code_verifier()
-    gateway_logger.debug(f"Authenticating user with \n"
-                         f"State: {state} \n"
-                         f"Code verifier: {code_verifier}")
-    await set_code_verifier(code_verifier, request.app['redis'], state)
-    raise web.HTTPFound(
-        avanpost.AUTHORIZATION_URL.format(
-            scopes=avanpost.SCOPES,
-            redirect_url=avanpost.AUTHORIZATION_REDIRECT_URL,
-            code_challenge=await get_code_challenge(code_verifier),
-            client_id=avanpost.CLIENT_ID,
-            state=state,
-        )
-    )
+    pkce = generate_pkce()
+    response = web.HTTPFound(avanpost.get_settings().build_authorization_url(
+        pkce.code_challenge, pkce.state))
+    await set_code_verifier(pkce.code_verifier, request.app['redis'],
+                            pkce.state, bind_client(request, response))
+    raise response
 
 
 async def exchange_code_for_token(pkce_code: str,
@@ -50,12 +44,26 @@ async def refresh_access_token(request: aiohttp.web.Request) -> Dict:
     redis_conn = request.app['redis']
     access_token, refresh_token = (request['payload']['access_token'],
                                    request['payload']['refresh_token'])
-    access_token_key = (avanpost.TOKEN_REDIS_KEY.format(access_token))
-
-    if await has_token_expired(redis_conn, access_token_key):
-        return await request_refresh(refresh_token)
-
-
+    if get_refresh_scheduler() is not None:
+        rotated = await pop_rotated_tokens(redis_conn, access_token,
+                                           refresh_token)
+        if rotated is not None:
+            return rotated
+
+    try:
+        expired = await has_token_expired(request, access_token)
+    except KeyError:
+        raise web.HTTPUnauthorized(reason="Session does not exist")
+
+    if expired:
+        try:
+            return await request_coalesced_refresh(redis_conn, refresh_token)
+        except RefreshFailedError as e:
+            # Another worker's refresh with this token failed
+            raise web.HTTPBadRequest(reason=str(e))
+
+
+@timed('view.sso_callback')
 async def sso_callback(request):
     """
     Address to exchange code_verifier for access_token
@@ -63,38 +71,35 @@ async def sso_callback(request):
     redis_conn, code, state = (request.app['redis'],
                                request.query.get('code'),
                                request.query.get('state'))
-    code_verifier_key = avanpost.CODE_VERIFIER_REDIS_KEY.format(state=state)
-    code_verifier = await redis_conn.get(code_verifier_key,
-                                         encoding='utf-8')
+    code_verifier = await pop_code_verifier(redis_conn, state,
+                                            client_key(request))
 
-    gateway_logger.debug(f"Code: {code}, \n"
-                         f"Code verifier: {code_verifier} \n"
-                         f"State: {state}")
+    log.debug('sso callback', code=code, code_verifier=code_verifier,
+              state=state)
 
     if not code:
         raise web.HTTPBadRequest(reason="PKCE code required")
+    if code_verifier is None:
+        # Unknown, expired, evicted or already consumed state
+        raise web.HTTPBadRequest(reason="Unknown login state")
 
     response_dict = await exchange_code_for_token(code, code_verifier)
     access_token = response_dict.get('access_token')
     refresh_token = response_dict.get('refresh_token')
 
-    await revoke_code_verifier(redis_conn, state)
-    await set_access_token(redis_conn,
-                           access_token,
-                           response_dict.get('expires_in'))
-    await set_refresh_token(redis_conn,
-                            access_token,
-                            refresh_token)
-
-    assert await redis_conn.exists(
-        f"{avanpost.TOKEN_REDIS_KEY}:{access_token}")
-    return web.HTTPFound(
+    response = web.HTTPFound(
         avanpost.TOKEN_REDIRECT_URL.format(access_token=access_token,
                                            refresh_token=refresh_token)
     )
+    await get_session_store(request.app).save(request, response,
+                                              access_token,
+                                              refresh_token,
+                                              response_dict.get('expires_in'))
+    return response
 
 
 @shielded
+@timed('view.logout')
 async def logout(request):
     """
     Logout user by revoking the authorization token in the request
@@ -104,47 +109,43 @@ async def logout(request):
     """
     redis_conn, sso_token = request.app['redis'], request['sso_token']
 
-    token_key = f"{avanpost.TOKEN_REDIS_KEY}:{sso_token}"
-    token = await redis_conn.get(token_key)
+    # Resolves to the current session if the scheduler rotated it
+    session, rotated = await resolve_session(request, sso_token)
 
-    if token is None:
+    if session is None:
         raise TokenAlreadyRevoked
 
-    response = requests.post(avanpost.TOKEN_REVOCATION_URL, data={
-        'client_id': avanpost.CLIENT_ID,
-        'client_secret': avanpost.CLIENT_SECRET,
-        'token': token,
-    })
-
-    if response.status_code != http.HTTPStatus.OK:
-        raise ValueError(
-            f'Could not revoke token from issuer. Issuer response: '
-            f'{response.json()}')
+    await request_revocation(session.refresh_token)
 
-    assert await redis_conn.exists(token_key)
-    await redis_conn.delete(token_key)
-    assert not await redis_conn.exists(token_key)
-    return web.HTTPNoContent()
+    response = web.HTTPNoContent()
+    await get_session_store(request.app).delete(request, response, sso_token)
+    if rotated is not None:
+        await discard_rotated_tokens(request, response, sso_token, rotated)
+    await revoke_token(redis_conn, sso_token,
+                       request.get('payload', {}).get('exp'))
+    revocation = request.app.get('revocation')
+    if revocation is not None:
+        revocation.add(sso_token)
+    return response
 
 
 @shielded
+@timed('view.refresh_tokens')
 async def refresh_tokens(request: aiohttp.web.Request):
-    redis_conn = request.app['redis']
-
     refresh_token_response = await refresh_access_token(request)
+    if refresh_token_response is None:
+        raise web.HTTPBadRequest(reason="Access token has not expired yet")
     access_token, refresh_token, expires_in = (
         refresh_token_response.get('access_token'),
         refresh_token_response.get('refresh_token'),
         refresh_token_response.get('expires_in')
     )
 
-    await utils.set_access_token(redis_conn,
-                                 access_token,
-                                 expires_in)
-    await utils.set_refresh_token(redis_conn,
-                                  access_token,
-                                  refresh_token)
-    return web.json_response({
+    response = web.json_response({
         "access_token": access_token,
         "refresh_token": refresh_token
     })
+    await get_session_store(request.app).save(
+        request, response, access_token, refresh_token, expires_in,
+        previous_access_token=request['payload']['access_token'])
+    return response
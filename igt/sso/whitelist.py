@@ -0,0 +1,58 @@
+import re
+from functools import lru_cache
+from typing import Iterable
+
+from aiohttp import web
+
+_DEFAULT_FLAGS = re.compile('').flags
+
+
+class WhitelistMatcher:
+    """
+    Whitelist patterns compiled into a single alternation regex.
+
+    Patterns with groups or global inline flags such as ``(?i)`` change
+    meaning or fail to compile inside an alternation, those are matched
+    one by one after it. Matching keeps ``re.match`` semantics of
+    ``check_request``. Verdicts
+    for plain (static) routes are memoised per route, other paths go
+    through a bounded LRU keyed by path.
+    """
+    PATH_CACHE_SIZE = 4096
+
+    def __init__(self, patterns: Iterable[str],
+                 path_cache_size: int = PATH_CACHE_SIZE):
+        patterns = tuple(patterns)
+        self.patterns = patterns
+        combinable, separate = [], []
+        for pattern in patterns:
+            compiled = re.compile(pattern)
+            if compiled.groups or compiled.flags != _DEFAULT_FLAGS:
+                separate.append(compiled)
+            else:
+                combinable.append(pattern)
+        if combinable:
+            separate.insert(0, re.compile(
+                '|'.join(f'(?:{pattern})' for pattern in combinable)))
+        self._regexes = tuple(separate)
+        self._route_verdicts = {}
+        self.match_path = lru_cache(maxsize=path_cache_size)(
+            self._match_path)
+
+    def _match_path(self, path: str) -> bool:
+        return any(regex.match(path) for regex in self._regexes)
+
+    def __call__(self, request: web.Request) -> bool:
+        if not self._regexes:
+            return False
+
+        route = request.match_info.route
+        resource = route.resource if route is not None else None
+        if not isinstance(resource, web.PlainResource):
+            return self.match_path(request.path)
+
+        verdict = self._route_verdicts.get(resource)
+        if verdict is None:
+            verdict = self._route_verdicts[resource] = self.match_path(
+                request.path)
+        return verdict